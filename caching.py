@@ -0,0 +1,75 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# LRU caches for constructors and decompositions (shared by quantum.py and
+# computer.py)
+
+from __future__ import print_function, division
+
+import collections
+import copy
+import functools
+import numpy as np
+
+# circuits ask for the same constant gates (C(X), P(pi/4), oracles,
+# tpow(H, n), ...) over and over, so constructors keep an LRU cache keyed
+# by their arguments (arrays by value, if small). everyone gets the same
+# object, so results are made read-only, and array arguments (and Gate
+# objects, which hold arrays) are copied first so a result that is, views
+# or holds an argument never aliases the caller's array. big results
+# aren't kept at all.
+
+def freeze(x):
+    if isinstance(x, np.ndarray): x.flags.writeable = False
+    elif isinstance(x, (list, tuple)):
+        for y in x: freeze(y)
+    elif hasattr(x, "__dict__"): # Gate objects
+        for v in vars(x).values(): freeze(v)
+    return x
+
+def _copy(x):
+    if isinstance(x, np.ndarray): return np.array(x)
+    if isinstance(x, (list, tuple)): return type(x)(_copy(y) for y in x)
+    if hasattr(x, "__dict__"): return copy.deepcopy(x) # Gate objects
+    return x
+
+def _size(x):
+    # entries in the arrays of x
+    if isinstance(x, np.ndarray): return x.size
+    if isinstance(x, (list, tuple)): return sum(_size(y) for y in x)
+    if hasattr(x, "__dict__"): return sum(_size(v) for v in vars(x).values())
+    return 0
+
+def _key(x, limit=2**12):
+    if isinstance(x, np.ndarray):
+        if x.size > limit: raise TypeError("not worth caching")
+        return ("array", x.shape, x.dtype.str, x.tobytes())
+    # (other objects, like Gates, hash by identity, which is fine as they
+    # don't change)
+    if isinstance(x, (list, tuple)):
+        return (type(x).__name__,) + tuple(_key(y, limit) for y in x)
+    return x
+
+def cached(maxsize=256, limit=2**12, keep=2**16, state=None):
+    # limit: arguments with bigger arrays aren't cached; keep: neither are
+    # results with more entries than this. state() is added to the key
+    # (e.g. the module's default_dtype)
+    def wrap(f):
+        cache = collections.OrderedDict()
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            try:
+                key = (_key(args, limit), _key(sorted(kwargs.items()), limit),
+                    state() if state else None)
+                hash(key)
+            except TypeError: return f(*args, **kwargs)
+            if key in cache: res = cache.pop(key)
+            else:
+                res = f(*_copy(args), **kwargs)
+                if _size(res) > keep: return res
+                freeze(res)
+            cache[key] = res
+            if len(cache) > maxsize: cache.popitem(last=False)
+            return res
+        inner.cache = cache
+        return inner
+    return wrap
@@ -5,7 +5,10 @@
 from __future__ import print_function, division
 # ! yes, I wrote this in Python 2
 
+import itertools
+import sys
 import numpy as np
+import caching
 
 # shorthand from quantum.py
 
@@ -14,6 +17,7 @@ class Caller:
     def __repr__(self): self.cb(); return self.msg
 
 def lw(n): np.set_printoptions(linewidth=n)
+
 suppon  = Caller(lambda: np.set_printoptions(suppress=True ),
     "Suppressing sci-notation for small values: ON")
 suppoff = Caller(lambda: np.set_printoptions(suppress=False),
@@ -28,60 +32,332 @@ def set_ind(xs, i, x):
 
 def lrange(*args, **kwargs): return list(range(*args, **kwargs))
 
+def product(xs):
+    acc = 1
+    for x in xs: acc *= x
+    return acc
+
 def verify_gate(gate):
     dims = gate.shape
     ndims = len(dims)
     assert ndims % 2 == 0
     assert dims[:ndims//2] == dims[ndims//2:]
 
+def get_rng(rng=None):
+    # None means the global np.random state (like QC.measure uses);
+    # otherwise a seed or a Generator
+    if rng is None: return np.random
+    if isinstance(rng, np.random.RandomState): return rng
+    return np.random.default_rng(rng)
+
+def unflatten(flat, dims):
+    # flat indices -> digits along a new last axis (like np.unravel_index,
+    # but much faster for qubits)
+    flat = flat[..., np.newaxis]
+    if all(d == 2 for d in dims):
+        return flat >> np.arange(len(dims) - 1, -1, -1) & 1
+    strides = np.cumprod((tuple(dims) + (1,))[:0:-1])[::-1]
+    return flat // strides % dims
+
+def select(probs, thresh=0.0, top=None):
+    # positions of probs >= thresh, in order; with top, just the top
+    # largest of them, largest first
+    sel = np.flatnonzero(probs >= thresh)
+    if top is None: return sel
+    if top < len(sel): sel = sel[np.argpartition(-probs[sel], top)[:top]]
+    return sel[np.lexsort((sel, -probs[sel]))]
+
 def show_complex(z):
     if not np.get_printoptions()["suppress"]: return str(z)
     return str((0.0 if abs(z.real) < 1e-6 else z.real)
       + 1.0j * (0.0 if abs(z.imag) < 1e-6 else z.imag))
 
+# precision
+# of new states and gates: complex64 halves memory and bandwidth and is
+# usually plenty for sampling (see check_precision)
+
+default_dtype = complex
+def set_dtype(dtype):
+    global default_dtype
+    default_dtype = dtype
+
+# gate kernels
+# working out the einsum subscripts on every gate was most of the cost,
+# so instead we decide how to apply a gate once per (state shape, gate
+# shape, targets) and then just reshape and hand things off to BLAS
+
+_plans = {}
+
+def _make_plan(dims, on):
+    k = len(on)
+    if list(on) == lrange(on[0], on[0] + k):
+        # targets are adjacent and in order, so view the state as (A, D, B)
+        A = product(dims[:on[0]])
+        D = product(dims[on[0]:on[0]+k])
+        B = product(dims[on[0]+k:])
+        return ("block", (A, D, B))
+    # otherwise contract with tensordot and move the outputs back in place
+    ndims = len(dims)
+    return ("tensordot", (tuple(on), tuple(range(k)),
+        lrange(ndims - k, ndims), list(on)))
+
+def gate_plan(dims, gshape, on):
+    key = (tuple(dims), tuple(gshape), tuple(on))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = _make_plan(dims, on)
+    return plan
+
+def _apply_strided(data, gate, on, out):
+    # out[.., o, ..] = sum_i gate[i, o] data[.., i, ..], one target slice at
+    # a time, so the only extra memory is one slice-sized temporary
+    k = len(on)
+    gdims = gate.shape[:k]
+    D = product(gdims)
+    mat = gate.reshape((D, D)).astype(out.dtype, copy=False)
+    src = np.moveaxis(data, on, lrange(k))
+    dst = np.moveaxis(out, on, lrange(k))
+    tmp = np.empty(src.shape[k:], dtype=out.dtype)
+    # (the Ellipsis keeps these views even when on covers every axis)
+    ins = [np.unravel_index(i, gdims) + (Ellipsis,) for i in range(D)]
+    for o in range(D):
+        acc = dst[ins[o]]
+        acc[...] = 0
+        for i in range(D):
+            if mat[i, o] == 0: continue
+            np.multiply(src[ins[i]], mat[i, o], out=tmp)
+            acc += tmp
+    return out
+
+def _apply_dense(data, gate, on, out=None):
+    # if out is given the result is written there (it must not overlap data)
+    kind, args = gate_plan(data.shape, gate.shape, on)
+    if out is not None and not (data.flags.c_contiguous
+            and out.flags.c_contiguous):
+        return _apply_strided(data, gate, on, out)
+    if kind == "block":
+        A, D, B = args
+        mat = gate.reshape((D, D)).astype(data.dtype, copy=False)
+        if D * B <= 32:
+            # few trailing entries: one (A, D*B) x (D*B, D*B) matmul
+            if B > 1: mat = np.kron(mat, np.eye(B, dtype=data.dtype))
+            res = np.dot(data.reshape((A, D * B)), mat,
+                out=None if out is None else out.reshape((A, D * B)))
+        else:
+            res = np.matmul(mat.T, data.reshape((A, D, B)),
+                out=None if out is None else out.reshape((A, D, B)))
+        return res.reshape(data.shape) if out is None else out
+    if out is not None: return _apply_strided(data, gate, on, out)
+    axes, gaxes, src, dst = args
+    res = np.tensordot(data, gate.astype(data.dtype, copy=False),
+        axes=(axes, gaxes))
+    return np.ascontiguousarray(np.moveaxis(res, src, dst))
+
+def apply_gate(data, gate, on, out=None):
+    # with out=None, data is left alone and a new array is returned.
+    # otherwise data may be updated in place, or the result written into
+    # out; either way the array holding the result is returned
+    if isinstance(gate, Gate): return gate.apply(data, on, out)
+    return _apply_dense(data, gate, on, out)
+
+def apply_fourier(data, axes, inverse=False, out=None, chunk=2**14):
+    # the QFT on the combined index of axes (axes[0] most significant),
+    # as one FFT. numpy's ifft has the QFT's sign; norm="ortho" makes it
+    # unitary. the result goes into out (or a new array), a slab of the
+    # other axes at a time, so the temporaries are only about chunk
+    # entries (or one transform, if that's bigger)
+    k = len(axes)
+    last = lrange(data.ndim - k, data.ndim)
+    src = np.moveaxis(data, axes, last)
+    if out is None: out = np.empty_like(data)
+    dst = np.moveaxis(out, axes, last)
+    fft = np.fft.fft if inverse else np.fft.ifft
+    lead = src.shape[:data.ndim - k]
+    size = product(src.shape)
+    split = 0
+    while split < len(lead) and size > chunk:
+        size //= lead[split]
+        split += 1
+    for idx in itertools.product(*[range(d) for d in lead[:split]]):
+        blk = src[idx]
+        res = fft(blk.reshape(blk.shape[:blk.ndim - k] + (-1,)), axis=-1,
+            norm="ortho")
+        dst[idx][...] = res.reshape(blk.shape)
+    return out
+
+def conditionals(pdf, ks):
+    # from the joint distribution pdf, the probability of each ks[i] given
+    # ks[:i]
+    probs = []
+    prev = 1.0
+    for i in range(len(ks)):
+        cur = pdf[tuple(ks[:i + 1])].sum()
+        probs.append(cur / prev if prev else 0.0)
+        prev = cur
+    return probs
+
 # the actual quantum computer
 
 class QC:
-    def __init__(self, dims):
+    # whether measure and measure_as take lists of subsystems (the multi_*
+    # methods fall back to one at a time otherwise)
+    joint_measure = True
+    def __init__(self, dims, inplace=False, data=None, dtype=None):
+        # data: start from this state instead of |0...0> (dims is then
+        # taken from its shape)
+        if data is not None: dims = data.shape
         try: dims = list(dims)
         except TypeError: dims = [2] * dims
         self.dims = dims
         self.ndims = len(self.dims)
-        self.data = np.zeros(dims, dtype=complex)
-        self.data[(0,) * len(dims)] = 1
-    def probs(self):
-        return np.abs(self.data) ** 2
+        if dtype is None: dtype = default_dtype
+        if data is None:
+            self.data = np.zeros(dims, dtype=dtype)
+            self.data[(0,) * len(dims)] = 1
+        else: self.data = data
+        # in-place mode: gates write into a scratch buffer which is then
+        # swapped with data, so memory stays at about 2x the state.
+        # (this means old references to qc.data get overwritten later)
+        self.inplace = inplace
+        self.buf = np.empty_like(self.data) if inplace else None
+        # marginals computed since the state last changed
+        self._marginals = {}
+    def probs(self, out=None):
+        if out is None: return np.abs(self.data) ** 2
+        np.abs(self.data, out=out)
+        return np.square(out, out=out)
+    def _probs(self):
+        # for internal use; in in-place mode this lives in the scratch
+        # buffer so it's only good until the next gate
+        if self.inplace: return self.probs(out=self.buf.real)
+        return self.probs()
     def measure_as(self, n, k, p=None):
-        if p is None:
-            pdf = np.einsum(self.probs(), lrange(self.ndims), [n])
-            #sel = np.random.choice(self.dims[n], p=pdf)
-            p = pdf[k]
+        # n and k can also be lists, for a joint measurement of several
+        # subsystems: the state is projected and renormalized in one pass
+        try: ns, ks = list(n), list(k)
+        except TypeError: ns, ks = [n], [k]
+        if p is None: p = self.marginal(ns)[tuple(ks)]
         if p == 0: raise ValueError("invalid measurement")
-        mask = np.zeros(set_ind([1] * self.ndims, n, self.dims[n]))
-        mask[tuple(set_ind([0] * self.ndims, n, k))] = 1 / np.sqrt(p)
-        self.data = self.data * mask
+        sel = [slice(None)] * self.ndims
+        for x, v in zip(ns, ks): sel[x] = v
+        sel = tuple(sel)
+        # zero out everything but the kept slice instead of multiplying
+        # by a mask
+        keep = self.data[sel] * float(1 / np.sqrt(p))
+        if self.inplace: self.data[...] = 0
+        else: self.data = np.zeros_like(self.data)
+        self.data[sel] = keep
+        self._marginals = {}
         return p
     def measure(self, n):
-        pdf = np.einsum(self.probs(), lrange(self.ndims), [n])
-        sel = np.random.choice(self.dims[n], p=pdf)
+        # with a list n, one joint outcome is drawn from the joint
+        # distribution; returns (probability, list of values)
+        try: ns, joint = list(n), True
+        except TypeError: ns, joint = [n], False
+        pdf = self.marginal(ns)
+        flat = np.random.choice(pdf.size, p=pdf.ravel() / pdf.sum())
+        sel = np.unravel_index(flat, pdf.shape)
         p = pdf[sel]
-        self.measure_as(n, sel, p=p)
-        return (p, sel)
+        self.measure_as(ns, sel, p=p)
+        if joint: return (p, [int(v) for v in sel])
+        return (p, int(sel[0]))
     def gate(self, gate, on):
         verify_gate(gate)
-        inp_inds = lrange(self.ndims)
-        out_inds = lrange(self.ndims)
         try: on = list(on)
         except TypeError: on = [on]
-        gate_inds = on + lrange(self.ndims, self.ndims + len(gate.shape) // 2)
-        for qnum, inum in enumerate(on):
-            out_inds[inum] = self.ndims + qnum
-        self.data = np.einsum(self.data, inp_inds, gate, gate_inds, out_inds)
+        res = apply_gate(self.data, gate, on, out=self.buf)
+        if res is self.buf: self.buf = self.data
+        self.data = res
+        self._marginals = {}
+    def fourier(self, qubits, inverse=False):
+        # QFT (or its inverse) on qubits; see qft
+        qubits = list(qubits)
+        if not qubits: return
+        axes = [self.data.ndim - self.ndims + x for x in qubits]
+        res = apply_fourier(self.data, axes, inverse, out=self.buf)
+        if res is self.buf: self.buf = self.data
+        self.data = res
+        self._marginals = {}
+    def reduced_density(self, ns):
+        # density matrix of subsystems ns (in that order), straight from
+        # the state: psi as a (ns, rest) matrix times its adjoint
+        ns = list(ns)
+        D = product(self.dims[x] for x in ns)
+        M = np.moveaxis(self.data, ns, lrange(len(ns))).reshape((D, -1))
+        return np.dot(M, M.conj().T)
+    def kraus(self, ops, on, rng=None):
+        # a noise channel given by Kraus operators ops, stochastically: one
+        # K is applied, picked with probability ||K psi||^2, and the state
+        # renormalized. averaged over many runs this is the channel (see
+        # noise.trajectories). returns the index of the K picked
+        try: on = list(on)
+        except TypeError: on = [on]
+        u = get_rng(rng).uniform()
+        # usually the first operator is the likely one, so stop as soon as
+        # the running total passes u
+        acc = 0.0
+        for i, K in enumerate(ops):
+            res = apply_gate(self.data, K, on)
+            p = np.vdot(res, res).real
+            if p == 0: continue
+            acc += p
+            pick, new = i, res / np.sqrt(p)
+            if acc >= u: break
+        self.data = new
+        self._marginals = {}
+        return pick
+    def marginal(self, ns):
+        # joint distribution of subsystems ns, with axes in the order of ns.
+        # kept (read-only) until the next gate or measurement, so measuring
+        # or sampling the same subsystems again skips the reduction. (if
+        # you write to qc.data yourself, assign a new array to it)
+        ns = list(ns)
+        key = (id(self.data), tuple(ns))
+        if key not in self._marginals:
+            others = tuple(i for i in range(self.ndims) if i not in ns)
+            pdf = self._probs().sum(axis=others, dtype=float)
+            pdf = np.transpose(pdf, np.argsort(np.argsort(ns)))
+            pdf.flags.writeable = False
+            self._marginals[key] = pdf
+        return self._marginals[key]
+    def sample(self, ns, shots=1, rng=None, counts=False):
+        # draw shots joint outcomes of ns without collapsing the state.
+        # returns a (shots, len(ns)) array of outcomes, or with counts=True
+        # an array of counts indexed like marginal(ns)
+        try: ns = list(ns)
+        except TypeError: ns = [ns]
+        rng = get_rng(rng)
+        pdf = self.marginal(ns)
+        # the histogram is one multinomial draw; individual shots are
+        # just that histogram expanded and shuffled
+        hist = rng.multinomial(shots, pdf.ravel() / pdf.sum())
+        if counts: return hist.reshape(pdf.shape)
+        flat = rng.permutation(np.repeat(np.arange(pdf.size), hist))
+        return unflatten(flat, pdf.shape)
+    def checkpoint(self, path):
+        # save the state as a .npy file; see restore
+        np.save(path, self.data)
+    def expectation(self, obs):
+        # <obs> for a sum of Pauli strings; see pauli.expectation
+        import pauli
+        return pauli.expectation(self, obs)
     # methods after here are just for convenience
     def multi_measure_as(self, ns, ks):
-        return [self.measure_as(n, k) for n, k in zip(ns, ks)]
+        # one joint projection; the probabilities are those of measuring
+        # each in turn, i.e. conditioned on the ones before
+        if not self.joint_measure:
+            return [self.measure_as(n, k) for n, k in zip(ns, ks)]
+        ns, ks = list(ns), list(ks)
+        probs = conditionals(self.marginal(ns), ks)
+        if 0 in probs: raise ValueError("invalid measurement")
+        self.measure_as(ns, ks)
+        return probs
     def multi_measure(self, ns):
-        return [self.measure(n) for n in ns]
+        if not self.joint_measure: return [self.measure(n) for n in ns]
+        ns = list(ns)
+        pdf = self.marginal(ns)
+        p, vals = self.measure(ns)
+        return list(zip(conditionals(pdf, vals), vals))
     def multi_gate(self, gate, ons):
         for on in ons: self.gate(gate, on)
     def multi_measure_as_2(self, ns, ks):
@@ -97,32 +373,60 @@ class QC:
             all_probs *= prob
             all_vals.append(val)
         return (all_probs, all_vals)
-    def flat_probs(self, thresh=0.0):
-        probs = self.probs()
-        for inds in alltups(self.dims):
-            prob = probs[inds]
-            if prob < thresh: continue
-            print("".join(str(x) for x in inds), prob)
+    def entries(self, thresh=0.0, top=None):
+        # (flat indices, probabilities, amplitudes) of the basis states with
+        # probability >= thresh, in index order. with top, only the top
+        # most likely of them, most likely first
+        probs = self._probs().ravel()
+        sel = select(probs, thresh, top)
+        return sel, probs[sel], self.data.ravel()[sel]
+    def stream(self, thresh=0.0, chunk=2**20):
+        # like entries, but yields them a chunk of the state at a time, so
+        # nothing bigger than a chunk is ever made
+        flat = self.data.ravel()
+        for start in range(0, len(flat), chunk):
+            amps = flat[start:start + chunk]
+            probs = np.abs(amps) ** 2
+            sel = np.flatnonzero(probs >= thresh)
+            yield sel + start, probs[sel], amps[sel]
+    def bitstrings(self, idx):
+        # labels of flat indices idx, like "0110"
+        digs = unflatten(np.asarray(idx), self.dims)
+        if max(self.dims) > 10:
+            return np.array(["".join(str(x) for x in row) for row in digs])
+        return ((digs + ord("0")).astype(np.uint8).view("S%d" % self.ndims)
+            .ravel().astype(str))
+    def dump(self, f=None, thresh=0.0, amps=False, chunk=2**20):
+        # writes "bitstring probability" (or amplitude) lines for the basis
+        # states with probability >= thresh to f (a file or a path;
+        # default stdout), streaming over the state
+        if isinstance(f, str):
+            with open(f, "w") as fh: return self.dump(fh, thresh, amps, chunk)
+        if f is None: f = sys.stdout
+        for idx, probs, vals in self.stream(thresh, chunk):
+            if not len(idx): continue
+            if amps: vals = [show_complex(z) for z in vals]
+            else: vals = [str(p) for p in probs]
+            f.write("".join(b + " " + v + "\n"
+                for b, v in zip(self.bitstrings(idx), vals)))
+    def flat_probs(self, thresh=0.0): self.dump(thresh=thresh)
     def flat_probs_nz(self): self.flat_probs(thresh=1e-8)
-    def flat_amps(self, thresh=0.0):
-        probs = self.probs()
-        for inds in alltups(self.dims):
-            prob = probs[inds]
-            if prob < thresh: continue
-            print("".join(str(x) for x in inds), end=" ")
-            print(show_complex(self.data[inds]))
+    def flat_amps(self, thresh=0.0): self.dump(thresh=thresh, amps=True)
     def flat_amps_nz(self): self.flat_amps(thresh=1e-8)
     def equal_superposition(self, states):
         num = len(states)
         val = 1 / np.sqrt(num)
         self.data[:] = 0
         for state in states: self.data[tuple(state)] = val
+        self._marginals = {}
 
 # shorthand methods
 
 QC.ma = QC.measure_as
 QC.m = QC.measure
 QC.g = QC.gate
+QC.s = QC.sample
+QC.k = QC.kraus
 QC.mma = QC.multi_measure_as
 QC.mm = QC.multi_measure
 QC.mg = QC.multi_gate
@@ -134,6 +438,463 @@ QC.fa = QC.flat_amps
 QC.fanz = QC.flat_amps_nz
 QC.esp = QC.equal_superposition
 
+# backends that measure one subsystem at a time (joint_measure = False)
+# still take lists in measure and measure_as: the subsystems are measured
+# in turn, with the probabilities multiplied as in multi_measure_2
+
+def per_subsystem(cls):
+    measure, measure_as = cls.measure, cls.measure_as
+    def measure_list(self, n, *args, **kwargs):
+        if np.ndim(n) == 0: return measure(self, n, *args, **kwargs)
+        p, vals = 1.0, []
+        for x in n:
+            q, v = measure(self, x, *args, **kwargs)
+            p = p * q
+            vals.append(v)
+        return (p, vals)
+    def measure_as_list(self, n, k, p=None):
+        if np.ndim(n) == 0: return measure_as(self, n, k, p)
+        p = 1.0
+        for x, v in zip(n, k): p = p * measure_as(self, x, v)
+        return p
+    cls.measure, cls.measure_as = measure_list, measure_as_list
+
+# registers on disk
+# for registers bigger than RAM: the state is an np.memmap'd .npy file,
+# and everything streams over chunks of it
+
+class MappedQC(QC):
+    joint_measure = False
+    # chunk is the number of amplitudes loaded into RAM at once.
+    # with dims=None, path is an existing file to pick up from (e.g. a
+    # checkpoint), which is then updated in place
+    def __init__(self, dims, path, chunk=2**22, dtype=None):
+        if dims is None:
+            data = np.lib.format.open_memmap(path, mode="r+")
+        else:
+            try: dims = list(dims)
+            except TypeError: dims = [2] * dims
+            data = np.lib.format.open_memmap(path, mode="w+",
+                dtype=default_dtype if dtype is None else dtype,
+                shape=tuple(dims))
+            data[(0,) * len(dims)] = 1
+        QC.__init__(self, None, data=data)
+        self.path = path
+        self.chunk = chunk
+    def chunks(self, on=()):
+        # yields views of the state covering it exactly once, each with
+        # every axis in on, and at most self.chunk entries if possible.
+        # axes are sliced away outermost first, so for gates on the last
+        # few axes the chunks are contiguous pieces of the file
+        split = []
+        size = product(self.dims)
+        for x in range(self.ndims):
+            if size <= self.chunk: break
+            if x in on: continue
+            split.append(x)
+            size //= self.dims[x]
+        for idx in itertools.product(*[range(self.dims[x]) for x in split]):
+            sel = [slice(None)] * self.ndims
+            for x, i in zip(split, idx): sel[x] = i
+            yield split, idx, self.data[tuple(sel)]
+    def gate(self, gate, on):
+        verify_gate(gate)
+        try: on = list(on)
+        except TypeError: on = [on]
+        for split, idx, blk in self.chunks(on):
+            rest = [x - sum(y < x for y in split) for x in on]
+            blk[...] = apply_gate(np.array(blk), gate, rest)
+    def fourier(self, qubits, inverse=False):
+        qubits = list(qubits)
+        for split, idx, blk in self.chunks(qubits):
+            rest = [x - sum(y < x for y in split) for x in qubits]
+            blk[...] = apply_fourier(np.array(blk), rest, inverse)
+    def marginal(self, ns):
+        ns = list(ns)
+        order = sorted(ns)
+        pdf = np.zeros([self.dims[x] for x in order])
+        for split, idx, blk in self.chunks():
+            keep = [x for x in range(self.ndims) if x not in split]
+            p = np.abs(np.array(blk)) ** 2
+            p = p.sum(axis=tuple(i for i, x in enumerate(keep) if x not in ns),
+                dtype=float)
+            sel = tuple(idx[split.index(x)] if x in split else slice(None)
+                for x in order)
+            pdf[sel] += p
+        return np.transpose(pdf, np.argsort(np.argsort(ns)))
+    def measure_as(self, n, k, p=None):
+        if p is None: p = self.marginal([n])[k]
+        if p == 0: raise ValueError("invalid measurement")
+        for split, idx, blk in self.chunks([n]):
+            m = n - sum(y < n for y in split)
+            for other in range(self.dims[n]):
+                if other == k: continue
+                blk[(slice(None),) * m + (other,)] = 0
+            blk[(slice(None),) * m + (k,)] *= 1 / np.sqrt(p)
+        return p
+    def measure(self, n):
+        pdf = self.marginal([n])
+        sel = np.random.choice(self.dims[n], p=pdf / pdf.sum())
+        p = pdf[sel]
+        self.measure_as(n, sel, p=p)
+        return (p, sel)
+    def reduced_density(self, ns):
+        # QC.reduced_density summed over chunks that keep the ns axes: each
+        # chunk is a block of columns of the (ns, rest) matrix
+        ns = list(ns)
+        D = product(self.dims[x] for x in ns)
+        rho = np.zeros((D, D), dtype=self.data.dtype)
+        for split, idx, blk in self.chunks(ns):
+            rest = [x - sum(y < x for y in split) for x in ns]
+            M = np.moveaxis(np.array(blk), rest, lrange(len(ns)))
+            M = M.reshape((D, -1))
+            rho += np.dot(M, M.conj().T)
+        return rho
+    def kraus(self, ops, on, rng=None):
+        # like QC.kraus, in two passes: one adding up ||K psi||^2 for every
+        # K a chunk at a time, then one applying the K picked
+        try: on = list(on)
+        except TypeError: on = [on]
+        norms = np.zeros(len(ops))
+        for split, idx, blk in self.chunks(on):
+            rest = [x - sum(y < x for y in split) for x in on]
+            blk = np.array(blk)
+            for i, K in enumerate(ops):
+                res = apply_gate(blk, K, rest)
+                norms[i] += np.vdot(res, res).real
+        u = get_rng(rng).uniform()
+        acc = 0.0
+        for i, p in enumerate(norms):
+            if p == 0: continue
+            acc += p
+            pick = i
+            if acc >= u: break
+        scale = 1 / np.sqrt(norms[pick])
+        for split, idx, blk in self.chunks(on):
+            rest = [x - sum(y < x for y in split) for x in on]
+            blk[...] = apply_gate(np.array(blk), ops[pick], rest) * scale
+        return pick
+    def entries(self, thresh=0.0, top=None):
+        # like QC.entries, a chunk at a time; with top, only the top so far
+        # are kept between chunks
+        parts = [(np.zeros(0, dtype=np.intp), np.zeros(0),
+            np.zeros(0, dtype=self.data.dtype))]
+        for part in self.stream(thresh, self.chunk):
+            parts.append(part)
+            if top is None: continue
+            idx, probs, amps = [np.concatenate(x) for x in zip(*parts)]
+            sel = np.sort(select(probs, thresh, top))
+            parts = [(idx[sel], probs[sel], amps[sel])]
+        idx, probs, amps = [np.concatenate(x) for x in zip(*parts)]
+        sel = select(probs, thresh, top)
+        return idx[sel], probs[sel], amps[sel]
+    def _whole(self, *args, **kwargs):
+        raise NotImplementedError("this needs the whole state in RAM; "
+            "use restore(path) to load it into a QC")
+    # this would make a full size array
+    _probs = _whole
+    def flush(self): self.data.flush()
+    def checkpoint(self, path):
+        self.flush()
+        QC.checkpoint(self, path)
+
+per_subsystem(MappedQC)
+MappedQC.ma = MappedQC.measure_as
+MappedQC.m = MappedQC.measure
+MappedQC.g = MappedQC.gate
+MappedQC.k = MappedQC.kraus
+
+def restore(path, mapped=False, chunk=2**22):
+    # load a state saved by qc.checkpoint. with mapped=True the file is
+    # used as the state of a MappedQC (and so modified by later gates)
+    if mapped: return MappedQC(None, path, chunk=chunk)
+    return QC(None, data=np.load(path))
+
+# batches of registers
+# for parameter sweeps: B copies of the same register evolve together, so
+# a sweep is one vectorized run instead of B runs of the gate loop
+
+class BatchQC(QC):
+    # data has a leading batch axis. gates are either shared (the usual
+    # tensors) or per-member stacks with a leading batch axis, like R(thetas)
+    joint_measure = False
+    def __init__(self, batch, dims, dtype=None):
+        try: dims = list(dims)
+        except TypeError: dims = [2] * dims
+        self.batch = batch
+        self.dims = dims
+        self.ndims = len(self.dims)
+        self.data = np.zeros([batch] + dims,
+            dtype=default_dtype if dtype is None else dtype)
+        self.data[(slice(None),) + (0,) * len(dims)] = 1
+        self.inplace = False
+        self.buf = None
+    def gate(self, gate, on):
+        try: on = list(on)
+        except TypeError: on = [on]
+        k = len(on)
+        on = [x + 1 for x in on]
+        if len(gate.shape) != 2 * k + 1:
+            verify_gate(gate)
+            self.data = apply_gate(self.data, gate, on)
+            return
+        # per-member gates: one batched matmul over (B, rest, D) views
+        verify_gate(gate[0])
+        D = product(gate.shape[1:k+1])
+        moved = np.moveaxis(self.data, on, lrange(-k, 0))
+        res = np.matmul(moved.reshape((self.batch, -1, D)),
+            gate.reshape((-1, D, D)).astype(self.data.dtype, copy=False))
+        self.data = np.ascontiguousarray(
+            np.moveaxis(res.reshape(moved.shape), lrange(-k, 0), on))
+    def reduced_density(self, ns):
+        # (B, D, D), one per member
+        ns = list(ns)
+        D = product(self.dims[x] for x in ns)
+        M = np.moveaxis(self.data, [x + 1 for x in ns],
+            lrange(1, len(ns) + 1)).reshape((self.batch, D, -1))
+        return np.matmul(M, M.conj().transpose((0, 2, 1)))
+    def kraus(self, ops, on, rng=None):
+        # like QC.kraus, with each member picking its own operator;
+        # returns an array of the indices picked
+        try: on = list(on)
+        except TypeError: on = [on]
+        outs = [apply_gate(self.data, K, [x + 1 for x in on]) for K in ops]
+        pdf = np.array([np.sum(np.abs(out.reshape((self.batch, -1))) ** 2,
+            axis=1, dtype=float) for out in outs]).T
+        sel = self._draw(pdf, 1, get_rng(rng))[:, 0]
+        p = pdf[np.arange(self.batch), sel]
+        data = np.empty_like(self.data)
+        for i, out in enumerate(outs): data[sel == i] = out[sel == i]
+        data /= np.sqrt(p).reshape((-1,) + (1,) * self.ndims)
+        self.data = data
+        return sel
+    def marginal(self, ns):
+        # (B, ...) joint distributions of ns, one per member
+        ns = list(ns)
+        others = tuple(i + 1 for i in range(self.ndims) if i not in ns)
+        pdf = self._probs().sum(axis=others, dtype=float)
+        return np.transpose(pdf, [0] + list(np.argsort(np.argsort(ns)) + 1))
+    def measure_as(self, n, k, p=None):
+        # p (and the return value) has one entry per member
+        if p is None: p = self.marginal([n])[:, k]
+        if np.any(p == 0): raise ValueError("invalid measurement")
+        self.data = self.data.copy()
+        for other in range(self.dims[n]):
+            if other == k: continue
+            self.data[(slice(None),) * (n + 1) + (other,)] = 0
+        scale = (1 / np.sqrt(p)).reshape((-1,) + (1,) * self.ndims)
+        self.data *= scale
+        return p
+    def measure(self, n, rng=None):
+        # each member gets its own outcome; returns arrays (p, sel)
+        pdf = self.marginal([n])
+        sel = self._draw(pdf, 1, get_rng(rng))[:, 0]
+        p = pdf[np.arange(self.batch), sel]
+        keep = np.arange(self.dims[n]) == sel[:, np.newaxis]
+        shape = [self.batch] + [1] * self.ndims
+        shape[n + 1] = self.dims[n]
+        self.data = self.data * (keep / np.sqrt(p)[:, np.newaxis]).reshape(shape)
+        return (p, sel)
+    def _draw(self, pdf, shots, rng):
+        # inverse-cdf draws for every member at once: offset member b's cdf
+        # by b so a single searchsorted covers the whole batch
+        pdf = pdf.reshape((self.batch, -1))
+        K = pdf.shape[1]
+        cdf = np.cumsum(pdf, axis=1)
+        cdf /= cdf[:, -1:]
+        offs = np.arange(self.batch)[:, np.newaxis]
+        u = rng.random((self.batch, shots)) + offs
+        flat = np.searchsorted((cdf + offs).ravel(), u.ravel(), side="right")
+        flat = flat.reshape(u.shape) - offs * K
+        return np.minimum(flat, K - 1)
+    def sample(self, ns, shots=1, rng=None, counts=False):
+        # like QC.sample, with a leading batch axis on the result
+        try: ns = list(ns)
+        except TypeError: ns = [ns]
+        pdf = self.marginal(ns)
+        flat = self._draw(pdf, shots, get_rng(rng))
+        if counts:
+            K = product(pdf.shape[1:])
+            offs = np.arange(self.batch)[:, np.newaxis] * K
+            return (np.bincount((flat + offs).ravel(), minlength=self.batch * K)
+                .reshape(pdf.shape))
+        return unflatten(flat, pdf.shape[1:])
+    def bitstrings(self, idx):
+        # entries, stream and dump work on the whole batch, so their flat
+        # indices include the member, which goes in front: "3 0110"
+        mem, idx = np.divmod(np.asarray(idx), product(self.dims))
+        return np.char.add(np.char.add(mem.astype(str), " "),
+            QC.bitstrings(self, idx))
+    def equal_superposition(self, states):
+        val = 1 / np.sqrt(len(states))
+        self.data[:] = 0
+        for state in states: self.data[(slice(None),) + tuple(state)] = val
+
+per_subsystem(BatchQC)
+BatchQC.ma = BatchQC.measure_as
+BatchQC.m = BatchQC.measure
+BatchQC.g = BatchQC.gate
+BatchQC.s = BatchQC.sample
+BatchQC.k = BatchQC.kraus
+BatchQC.esp = BatchQC.equal_superposition
+
+# deferred circuits
+# every qc.g is a full pass over the state, so for long gate sequences we
+# record them first, fuse what we can, and only then touch the state
+
+def gate_dims(gate):
+    return tuple(gate.shape[:len(gate.shape)//2])
+
+def compose(first, second):
+    # "first, then second" on the same targets
+    D = product(gate_dims(first))
+    return (np.dot(first.reshape((D, D)), second.reshape((D, D)))
+        .reshape(first.shape))
+
+def is_identity(gate, tol=1e-12):
+    D = product(gate_dims(gate))
+    return np.allclose(gate.reshape((D, D)), np.eye(D), rtol=0, atol=tol)
+
+def fuse(ops, block=4):
+    # first pass: merge each gate into the last gate on exactly the same
+    # targets (everything in between is on other wires, so it commutes),
+    # dropping the result if it's the identity, e.g. H.H or CNOT.CNOT
+    merged = []
+    for gate, on in ops:
+        on = tuple(on)
+        # small structured gates are cheap to make dense, big ones are
+        # left alone (and just end up between blocks)
+        if isinstance(gate, Gate) and len(on) <= block: gate = gate.dense()
+        for i in range(len(merged) - 1, -1, -1):
+            if set(merged[i][1]) & set(on): break
+        else: i = None
+        if (i is not None and merged[i][1] == on
+                and len(on) <= block):
+            gate = compose(merged[i][0], gate)
+            if is_identity(gate): del merged[i]
+            else: merged[i] = (gate, on)
+        else:
+            merged.append((gate, on))
+    # second pass: pack runs of small gates into blocks of up to `block`
+    # targets, so each run is one pass over the state
+    fused = []
+    run = []
+    def flush():
+        if len(run) == 1: fused.append(run[0])
+        elif run:
+            block_on = []
+            block_dims = []
+            for gate, on in run:
+                for x, d in zip(on, gate_dims(gate)):
+                    if x not in block_on:
+                        block_on.append(x)
+                        block_dims.append(d)
+            acc = identity(block_dims)
+            for gate, on in run:
+                acc = apply_gate(acc, gate,
+                    [len(block_on) + block_on.index(x) for x in on])
+            fused.append((acc, tuple(block_on)))
+        del run[:]
+    for gate, on in merged:
+        if len(on) > block:
+            flush()
+            fused.append((gate, on))
+            continue
+        wires = set(on)
+        for _, other in run: wires |= set(other)
+        if len(wires) > block: flush()
+        run.append((gate, on))
+    flush()
+    return fused
+
+class Circuit:
+    # records gates instead of applying them; has the same gate/multi_gate
+    # methods as QC, so e.g. diffusion(circ, qubits) records onto it
+    def __init__(self, ops=()):
+        self.ops = [(gate, tuple(on)) for gate, on in ops]
+    def __len__(self): return len(self.ops)
+    def gate(self, gate, on):
+        verify_gate(gate)
+        try: on = tuple(on)
+        except TypeError: on = (on,)
+        self.ops.append((gate, on))
+    def multi_gate(self, gate, ons):
+        for on in ons: self.gate(gate, on)
+    def optimize(self, block=4):
+        return Circuit(fuse(self.ops, block=block))
+    def run(self, qc, optimize=True, block=4):
+        ops = fuse(self.ops, block=block) if optimize else self.ops
+        for gate, on in ops: qc.gate(gate, list(on))
+        return qc
+    def unitary(self, dims, optimize=True, block=4):
+        return unitary(self.ops, dims, optimize, block)
+
+Circuit.g = Circuit.gate
+Circuit.mg = Circuit.multi_gate
+Circuit.opt = Circuit.optimize
+
+def _gate_error(gate):
+    # roughly how many roundings each output amplitude picks up
+    if isinstance(gate, Permutation): return 0.0
+    if isinstance(gate, Diagonal): return 6.0
+    if isinstance(gate, Controlled): return _gate_error(gate.gate)
+    D = product(gate_dims(gate))
+    return 2 * (D + 2) * np.sqrt(D)
+
+def check_precision(program, dims, dtype=np.complex64):
+    # runs program (a Circuit, or a function that records gates onto one,
+    # like lambda circ: gd(circ, range(3))) from |0...0> in dtype and in
+    # complex128, and returns (err, bound): err is the 2-norm distance
+    # between the two final states, bound is sum over gates of
+    # 2 (D + 2) sqrt(D) u, for a gate on D basis states and u the unit
+    # roundoff of dtype. a D-term complex dot product is off by at most
+    # about sqrt(2) (D + 2) u times the sum of |terms|, which for a
+    # unitary is at most sqrt(D) times the norm, plus rounding the gate
+    # itself; unitaries don't grow earlier errors. so err <= bound
+    # (usually by orders of magnitude)
+    if not isinstance(program, Circuit):
+        circ = Circuit()
+        program(circ)
+        program = circ
+    low = program.run(QC(dims, dtype=dtype), optimize=False)
+    ref = program.run(QC(dims, dtype=complex), optimize=False)
+    err = np.linalg.norm((low.data - ref.data).ravel())
+    u = np.finfo(dtype).eps / 2
+    bound = u * sum(_gate_error(gate) for gate, on in program.ops)
+    return err, bound
+
+# cached constructors (see caching.py), also keyed by default_dtype
+
+def cached(maxsize=256, limit=2**12, keep=2**16):
+    return caching.cached(maxsize, limit, keep, state=lambda: default_dtype)
+
+# circuit unitaries
+
+def unitary(ops, dims, optimize=True, block=4):
+    # the (D, D) matrix of a circuit (a Circuit or a list of (gate, on)),
+    # out index first as in quantum.py. its columns are the images of the
+    # basis states, so it is just the circuit run on the identity: as an
+    # (out..., in...) tensor that's a register whose first half of the
+    # axes are the wires, and each gate is one kernel pass over it instead
+    # of a kron with identities and a full matmul. with optimize, runs of
+    # gates are fused into blocks first, so a layer of small gates is one
+    # pass. results (up to 10 qubits) are cached by the gates, targets and
+    # dims
+    try: dims = tuple(dims)
+    except TypeError: dims = (2,) * dims
+    ops = tuple((gate, tuple(on) if np.ndim(on) else (on,))
+        for gate, on in getattr(ops, "ops", ops))
+    return _unitary(ops, dims, optimize, block)
+
+@cached(maxsize=8, keep=2**20)
+def _unitary(ops, dims, optimize, block):
+    # (not identity(dims), which would keep a D x D copy in its cache)
+    D = product(dims)
+    qc = QC(None, data=np.eye(D, dtype=default_dtype).reshape(dims * 2),
+        inplace=True)
+    Circuit(ops).run(qc, optimize, block)
+    return qc.data.reshape((D, D))
+
 # helpers for constructing gates
 
 def logn(x, n):
@@ -141,16 +902,22 @@ def logn(x, n):
     if n ** val != x: raise ValueError("invalid dimensions")
     return val
 
-def qbgate(*args):
+@cached()
+def qbgate(*args, **kwargs):
     # "qubit gate"
     # as opposed to a qutrit or ququart gate
     qubits = logn(len(args), 4)
     dims = (2,) * (qubits * 2)
     #gate = np.array(args, dtype=complex).reshape(dims)
     # tranpose since we usually see the last dimension as input
-    gate = (np.array(args, dtype=complex)
-        .reshape((2**qubits,)*2).T.reshape(dims))
-    return gate
+    # entries can also be arrays, which gives a stack of gates with the
+    # batch axes in front (for BatchQC), e.g. R(thetas)
+    dtype = kwargs.get("dtype", default_dtype)
+    args = np.broadcast_arrays(*args)
+    batch = args[0].shape
+    gate = np.moveaxis(np.array(args, dtype=dtype)
+        .reshape((2**qubits,)*2 + batch), [0, 1], [-1, -2])
+    return gate.reshape(batch + dims)
 
 # more shorthands
 
@@ -191,47 +958,144 @@ CNOT = qbgate(
 )
 
 def alltups(dims):
-    all_inds = np.indices(dims).reshape((len(dims), -1)).T
-    for inds in all_inds: yield tuple(inds)
+    return itertools.product(*[range(d) for d in dims])
 
 def bintups(n):
     for inds in alltups((2,) * n): yield inds
 
-def identity(dims):
+@cached()
+def identity(dims, dtype=None):
     try: dims = tuple(dims)
     except TypeError: dims = (2,) * dims
-    arr = np.zeros(dims * 2, dtype=complex)
-    for inds in alltups(dims):
-        arr[inds * 2] = 1
-    return arr
+    return np.eye(product(dims),
+        dtype=default_dtype if dtype is None else dtype).reshape(dims * 2)
+
+# structured gates
+# these have a shape like the dense gate tensors (and np.asarray gives the
+# dense tensor), but QC.gate applies them without ever building it
 
+class Gate(object):
+    def __array__(self, dtype=None, copy=None):
+        arr = self.dense()
+        return arr if dtype is None else arr.astype(dtype)
+    def conj(self): return np.conj(self.dense())
+
+class Controlled(Gate):
+    # gate on the last targets, applied only where all of the first
+    # `controls` targets are 1; the rest of the state is never touched
+    def __init__(self, gate, controls=1):
+        verify_gate(gate)
+        self.gate = gate
+        self.controls = controls
+        self.shape = ((2,) * controls + gate_dims(gate)) * 2
+    def dense(self):
+        dims = gate_dims(self.gate)
+        arr = np.asarray(self.gate)
+        for i in range(self.controls):
+            ctrl = np.zeros(((2,) + dims) * 2, dtype=arr.dtype)
+            dim_ranges = tuple(slice(dim) for dim in dims)
+            ctrl[((0,) + dim_ranges) * 2] = identity(dims, arr.dtype)
+            ctrl[((1,) + dim_ranges) * 2] = arr
+            arr = ctrl
+            dims = (2,) + dims
+        return arr
+    def apply(self, data, on, out=None):
+        if out is None: data = data.copy()
+        ctrls = on[:self.controls]
+        sel = [slice(None)] * data.ndim
+        for x in ctrls: sel[x] = 1
+        sel = tuple(sel)
+        # indices of the targets once the control axes are sliced away
+        rest = [x - sum(y < x for y in ctrls) for x in on[self.controls:]]
+        view = data[sel]
+        res = apply_gate(view, self.gate, rest,
+            None if out is None else out[sel])
+        if res is not view: view[...] = res
+        return data
+    def conj(self): return Controlled(self.gate.conj(), self.controls)
+
+class Diagonal(Gate):
+    # diag has one axis per target; applied as an elementwise multiply
+    def __init__(self, diag, dtype=None):
+        self.diag = np.asarray(diag,
+            dtype=default_dtype if dtype is None else dtype)
+        self.shape = self.diag.shape * 2
+    def dense(self):
+        dims = self.diag.shape
+        arr = np.zeros(dims * 2, dtype=self.diag.dtype)
+        inds = tuple(np.indices(dims).reshape((len(dims), -1)))
+        arr[inds * 2] = self.diag.ravel()
+        return arr
+    def apply(self, data, on, out=None):
+        k = len(on)
+        fac = self.diag.reshape(self.diag.shape + (1,) * (data.ndim - k))
+        fac = np.moveaxis(fac, lrange(k), on).astype(data.dtype, copy=False)
+        if out is None: return data * fac
+        data *= fac
+        return data
+    def conj(self): return Diagonal(self.diag.conj(), self.diag.dtype)
+
+class Permutation(Gate):
+    # basis state i (flattened over the targets) goes to basis state
+    # perm[i]; applied as a gather
+    def __init__(self, perm, dims):
+        perm = np.asarray(perm)
+        self.dims = tuple(dims)
+        self.shape = self.dims * 2
+        self.perm = perm
+        self.src = np.empty_like(perm)
+        self.src[perm] = np.arange(len(perm))
+    def dense(self):
+        D = len(self.src)
+        arr = np.zeros((D, D), dtype=default_dtype)
+        arr[self.src, np.arange(D)] = 1
+        return arr.reshape(self.shape)
+    def conj(self): return self
+    def apply(self, data, on, out=None):
+        if out is None: out = np.empty_like(data)
+        k = len(on)
+        kind, args = gate_plan(data.shape, self.shape, on)
+        if (kind == "block" and data.flags.c_contiguous
+                and out.flags.c_contiguous):
+            np.take(data.reshape(args), self.src, axis=1,
+                out=out.reshape(args), mode="clip")
+            return out
+        src = np.moveaxis(data, on, lrange(k))
+        dst = np.moveaxis(out, on, lrange(k))
+        # gather a few basis states of the targets at a time, so (like
+        # _apply_strided) the only temporary is about a slice in size
+        D = len(self.src)
+        step = max(1, 2**16 // product(src.shape[k:]))
+        for start in range(0, D, step):
+            os = np.arange(start, min(start + step, D))
+            dst[np.unravel_index(os, self.dims)] = \
+                src[np.unravel_index(self.src[os], self.dims)]
+        return out
+
+@cached()
 def C(gate):
-    verify_gate(gate)
-    dims = gate.shape[:len(gate.shape)//2]
-    arr = np.zeros(((2,) + dims) * 2, dtype=complex)
-    dim_ranges = tuple(slice(dim) for dim in dims)
-    arr[((0,) + dim_ranges) * 2] = identity(dims)
-    arr[((1,) + dim_ranges) * 2] = gate
-    return arr
+    if isinstance(gate, Controlled):
+        return Controlled(gate.gate, gate.controls + 1)
+    return Controlled(gate)
 
+@cached()
 def phase_oracle(*args):
     qubits = logn(len(args), 2)
-    arr = np.zeros((2,) * (qubits * 2), dtype=complex)
-    for inds, arg in zip(bintups(qubits), args):
-        arr[inds * 2] = 1 - 2 * arg
-    return arr
+    return Diagonal((1 - 2 * np.array(args)).reshape((2,) * qubits))
 
 def xor_tups(xs, ys): return tuple(x ^ y for x, y in zip(xs, ys))
 
+@cached()
 def xor_oracle(*args):
     # ex. [0, 0], [0, 1], [0, 0], [1, 0]
+    # |x>|y> -> |x>|y xor f(x)>, as a permutation of the basis states
     qubits = logn(len(args), 2)
     outs = len(args[0])
-    arr = np.zeros((2,) * ((qubits + outs) * 2), dtype=complex)
-    for in_inds, arg in zip(bintups(qubits), args):
-        for out_inds in bintups(outs):
-            arr[in_inds + out_inds + in_inds + xor_tups(out_inds, arg)] = 1
-    return arr
+    fx = np.dot(np.array(args, dtype=np.int64).reshape((-1, outs)),
+        2 ** np.arange(outs - 1, -1, -1))
+    inp, out = np.divmod(np.arange(2 ** (qubits + outs)), 2 ** outs)
+    perm = inp * 2 ** outs + (out ^ fx[inp])
+    return Permutation(perm, (2,) * (qubits + outs))
 
 def bits(x, n):
     return [(x >> i) & 1 for i in range(n)][::-1]
@@ -241,13 +1105,29 @@ def unbits(xs):
     for x in xs: accum = accum * 2 + x
     return accum
 
-def qft(qc, qubits):
+def qft_gates(qc, qubits, inverse=False):
+    # the textbook circuit: H and controlled phases, then reverse the order
+    qubits = list(qubits)
+    sign = -1 if inverse else 1
+    ops = []
     for i, x in enumerate(qubits):
-        qc.gate(H, x)
+        ops.append((H, x))
         for j, y in enumerate(qubits[i+1:]):
-            qc.gate(C(P(2*pi/2**(j+2))), [y, x])
+            ops.append((C(P(sign*2*pi/2**(j+2))), [y, x]))
     for i in range(len(qubits) // 2):
-        qc.gate(SWAP, [qubits[i], qubits[~i]])
+        ops.append((SWAP, [qubits[i], qubits[~i]]))
+    if inverse: ops.reverse()
+    for gate, on in ops: qc.gate(gate, on)
+
+def qft(qc, qubits, inverse=False):
+    # |x> -> sum_y e^(2 pi i x y / N) |y> / sqrt(N), with qubits[0] the most
+    # significant bit of x and y. registers that hold amplitudes densely
+    # do this as one FFT (qc.fourier); anything else, like a Circuit, gets
+    # the O(n^2) gates of qft_gates
+    if hasattr(qc, "fourier"): qc.fourier(qubits, inverse)
+    else: qft_gates(qc, qubits, inverse)
+
+def iqft(qc, qubits): qft(qc, qubits, inverse=True)
 
 def cf(x, num=100):
     result = []
@@ -272,13 +1152,18 @@ def cf_approx(xs, thresh=50):
         a, b = b + x * a, a
     return a, b
 
+@cached()
+def controlled_z(n):
+    # Z on the last of n qubits, controlled by the rest
+    gate = Z
+    for i in range(n - 1): gate = C(gate)
+    return gate
+
 def diffusion(qc, qubits):
     qc.mg(H, qubits)
     qc.mg(X, qubits)
-    gate = Z
-    for i in range(len(qubits) - 1): gate = C(gate)
     # don't want to mess with ancillas
-    qc.g(gate, qubits)
+    qc.g(controlled_z(len(qubits)), qubits)
     qc.mg(X, qubits)
     qc.mg(H, qubits)
 
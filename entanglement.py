@@ -0,0 +1,100 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Entanglement and information measures of registers
+
+from __future__ import print_function, division
+
+import numpy as np
+from computer import *
+
+# everything here works on the state vector of a QC (or every member of a
+# BatchQC at once): splitting the subsystems into ns and the rest, psi is
+# a (D_ns, D_rest) matrix whose singular values are the Schmidt
+# coefficients, and their squares are the spectrum of the reduced density
+# matrix of ns. so no density matrix of the whole register is ever built.
+# for the spectrum alone, M M^dag on the smaller side of the cut and its
+# eigenvalues are several times faster than an SVD.
+# other registers (DensityQC, SparseQC, MPSQC, StabilizerQC, and MappedQC,
+# whose psi isn't in RAM) get entropies and purities from the eigenvalues
+# of qc.reduced_density(ns) instead; schmidt and all_cuts need psi itself.
+# (except that a StabilizerQC has a flat reduced spectrum, so qc.entropy
+# counts stabilizers for every alpha, and all_cuts works too)
+# entropies are in bits.
+
+def state_vector(qc):
+    # whether qc.data is psi in RAM (with any batch axes in front)
+    return type(qc) is QC or isinstance(qc, BatchQC)
+
+def bipartition(qc, ns):
+    # psi as a (..., D_ns, D_rest) matrix; leading axes are the batch
+    if not state_vector(qc):
+        raise TypeError("needs the state vector of a QC or BatchQC, not a "
+            + type(qc).__name__)
+    ns = list(ns)
+    lead = qc.data.ndim - qc.ndims
+    data = np.moveaxis(qc.data, [lead + x for x in ns],
+        lrange(lead, lead + len(ns)))
+    D = product(qc.dims[x] for x in ns)
+    return data.reshape(data.shape[:lead] + (D, -1))
+
+def schmidt(qc, ns, vectors=False):
+    # Schmidt coefficients of psi across ns | rest, largest first; with
+    # vectors=True also the Schmidt bases, as (U, s, Vh) like np.linalg.svd
+    if vectors: return np.linalg.svd(bipartition(qc, ns), full_matrices=False)
+    return np.linalg.svd(bipartition(qc, ns), compute_uv=False)
+
+def spectrum(M):
+    # squared singular values of (stacks of) M, in no particular order
+    if M.shape[-2] > M.shape[-1]: M = np.swapaxes(M, -1, -2)
+    gram = np.matmul(M, np.swapaxes(M, -1, -2).conj())
+    return np.maximum(np.linalg.eigvalsh(gram), 0)
+
+def reduced_spectrum(qc, ns):
+    # eigenvalues of the reduced density matrix of ns
+    if state_vector(qc): return spectrum(bipartition(qc, ns))
+    return np.maximum(np.linalg.eigvalsh(qc.reduced_density(ns)), 0)
+
+def spectrum_entropy(p, alpha=1):
+    # Renyi entropy of order alpha of distributions along the last axis of
+    # p (alpha=1 is Shannon/von Neumann, alpha=np.inf min-entropy)
+    if alpha == 1:
+        logs = np.zeros_like(p)
+        np.log2(p, out=logs, where=p > 0)
+        return 0.0 - np.sum(p * logs, axis=-1) # no -0.0
+    if alpha == np.inf: return -np.log2(np.max(p, axis=-1))
+    return np.log2(np.sum(p ** alpha, axis=-1)) / (1 - alpha)
+
+def entanglement_entropy(qc, ns, alpha=1):
+    # von Neumann (or Renyi, alpha != 1) entropy of the reduced state of ns
+    if hasattr(qc, "entropy"): return float(qc.entropy(ns))
+    return spectrum_entropy(reduced_spectrum(qc, ns), alpha)
+
+def renyi(qc, ns, alpha=2): return entanglement_entropy(qc, ns, alpha)
+
+def purity(qc, ns):
+    # tr(rho_ns^2)
+    if hasattr(qc, "entropy"): return 2.0 ** -qc.entropy(ns)
+    return np.sum(reduced_spectrum(qc, ns) ** 2, axis=-1)
+
+def mutual_information(qc, a, b):
+    # S(a) + S(b) - S(a, b), for disjoint sets of subsystems a and b
+    a, b = list(a), list(b)
+    return (entanglement_entropy(qc, a) + entanglement_entropy(qc, b)
+        - entanglement_entropy(qc, a + b))
+
+def all_cuts(qc, alpha=1):
+    # entropy across every cut of the chain, 0..k | k+1..n-1 for
+    # k = 0..n-2; the last axis of the result is the cut. each cut is just
+    # another reshape of the same data
+    if hasattr(qc, "entropy"):
+        return np.array([qc.entropy(lrange(k + 1))
+            for k in range(qc.ndims - 1)], dtype=float)
+    if not state_vector(qc):
+        raise TypeError("needs the state vector of a QC or BatchQC, not a "
+            + type(qc).__name__)
+    lead = qc.data.ndim - qc.ndims
+    batch = qc.data.shape[:lead]
+    res = [spectrum_entropy(spectrum(qc.data.reshape(
+        batch + (product(qc.dims[:k + 1]), -1))), alpha)
+        for k in range(qc.ndims - 1)]
+    return np.stack(res, axis=-1) if res else np.zeros(batch + (0,))
@@ -0,0 +1,111 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Running many circuits (parameter sweeps, shots, noisy trajectories)
+# across processes
+
+from __future__ import print_function, division
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import computer
+from computer import *
+
+# the program is either a Circuit, or a function build(qc, param, rng)
+# which applies gates to qc (like qft or diffusion do). it gets pickled
+# to the workers, so it has to be a top-level function.
+#
+# results are written straight into a shared memory block (one slot per
+# param), and the initial state (if any) is read from one, so neither
+# goes through pickling. each param gets its own RNG stream spawned from
+# one seed, so results don't depend on how the work was split up.
+
+def _attach(name):
+    try: return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # before Python 3.13
+        return shared_memory.SharedMemory(name=name)
+
+def _run_chunk(program, params, inds, seqs, dims, dtype, init, qubits,
+        shots, out):
+    # init and out are (shm name, shape, dtype), or None for no init.
+    # dtype is that of the registers (the workers may not share our
+    # default_dtype)
+    blocks = []
+    try:
+        if init is not None:
+            blocks.append(_attach(init[0]))
+            init_arr = np.ndarray(init[1], dtype=init[2], buffer=blocks[-1].buf)
+        blocks.append(_attach(out[0]))
+        out_arr = np.ndarray(out[1], dtype=out[2], buffer=blocks[-1].buf)
+        for i, param, seq in zip(inds, params, seqs):
+            rng = np.random.default_rng(seq)
+            qc = QC(dims, dtype=dtype)
+            if init is not None: qc.data[...] = init_arr
+            if isinstance(program, Circuit): program.run(qc)
+            else: program(qc, param, rng)
+            if shots: out_arr[i] = qc.sample(qubits, shots, rng=rng, counts=True)
+            else: out_arr[i] = qc.data
+        del out_arr
+        if init is not None: del init_arr
+    finally:
+        for block in blocks: block.close()
+
+def _share(arr):
+    block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+    view[...] = arr
+    return block, (block.name, arr.shape, arr.dtype.str)
+
+def sweep(program, params, dims, qubits=None, shots=0, seed=None,
+        init=None, workers=None, merge=False):
+    # runs program once per param. with shots, samples qubits that many
+    # times per param and returns (len(params), ...) histograms indexed
+    # like QC.marginal (summed into one with merge=True); otherwise
+    # returns the (len(params),) + dims final states
+    params = list(params)
+    try: dims = list(dims)
+    except TypeError: dims = [2] * dims
+    seqs = np.random.SeedSequence(seed).spawn(len(params))
+    # registers are in the dtype of init, or else the current default
+    if isinstance(init, QC): init = init.data
+    if init is not None: init = np.asarray(init)
+    if init is not None and np.iscomplexobj(init): state = init.dtype
+    else: state = np.dtype(computer.default_dtype)
+    if shots:
+        if qubits is None: qubits = lrange(len(dims))
+        try: qubits = list(qubits)
+        except TypeError: qubits = [qubits]
+        shape = [len(params)] + [dims[q] for q in qubits]
+        dtype = np.int64
+    else:
+        shape = [len(params)] + dims
+        dtype = state
+    if workers is None: workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(params)))
+    blocks = []
+    try:
+        if init is not None:
+            block, init_desc = _share(init.astype(state, copy=False))
+            blocks.append(block)
+        else: init_desc = None
+        block, out_desc = _share(np.zeros(shape, dtype=dtype))
+        blocks.append(block)
+        chunks = np.array_split(np.arange(len(params)), workers)
+        jobs = [(program, [params[i] for i in inds], list(inds),
+            [seqs[i] for i in inds], dims, state, init_desc, qubits, shots,
+            out_desc)
+            for inds in chunks if len(inds)]
+        if workers == 1:
+            for job in jobs: _run_chunk(*job)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                for fut in [pool.submit(_run_chunk, *job) for job in jobs]:
+                    fut.result()
+        res = np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return res.sum(axis=0) if merge else res
@@ -0,0 +1,58 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Grover search driver
+
+from __future__ import print_function, division
+
+import numpy as np
+import computer
+from computer import *
+
+# the oracle is compiled once into a sign per basis state, and the
+# diffusion is the reflection 2|s><s| - I about the uniform superposition,
+# done directly on the (real) amplitudes: new = 2 mean - amp. so each
+# iteration is a dot product for the mean plus two in-place passes,
+# with no gate tensors at all. (unlike gd, there is no global phase of -1)
+
+def oracle_signs(n, target):
+    # +1 per basis state, -1 on the marked ones. target is either a
+    # predicate taking an array of all the indices (qubit 0 is the most
+    # significant bit, as in unbits) and returning an array of bools,
+    # or a list of marked indices
+    x = np.arange(2 ** n)
+    if callable(target): mark = np.asarray(target(x), dtype=bool)
+    else:
+        mark = np.zeros(2 ** n, dtype=bool)
+        mark[list(target)] = True
+    return np.where(mark, -1.0, 1.0)
+
+def optimal_iterations(N, M):
+    # number of iterations that maximizes the chance of measuring one of
+    # M marked items out of N
+    if M == 0 or M == N: return 0
+    theta = np.arcsin(np.sqrt(M / N))
+    return max(0, int(round(pi / (4 * theta) - 0.5)))
+
+def grover_step(amps, flip):
+    # one iteration on the flat real amplitudes, in place. flip is minus
+    # the oracle signs: new = 2 mean(sign * amps) - sign * amps
+    mean = -np.dot(flip, amps) / len(amps)
+    amps *= flip
+    amps += 2 * mean
+
+def grover(n, target, iters=None, shots=1, rng=None):
+    # returns a dict with the number of iterations and of marked items,
+    # the probability of measuring a marked item, shots sampled outcomes
+    # (as in QC.sample) and the final register
+    signs = oracle_signs(n, target)
+    N = len(signs)
+    M = int(np.sum(signs < 0))
+    if iters is None: iters = optimal_iterations(N, M)
+    amps = np.full(N, 1 / np.sqrt(N))
+    flip = -signs
+    for i in range(iters): grover_step(amps, flip)
+    qc = QC(None,
+        data=amps.astype(computer.default_dtype).reshape((2,) * n))
+    return {"iters": iters, "marked": M,
+        "p_success": float(np.sum(amps[signs < 0] ** 2)),
+        "samples": qc.sample(lrange(n), shots, rng), "qc": qc}
@@ -0,0 +1,263 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Matrix product state simulation, for wide circuits with little entanglement
+
+from __future__ import print_function, division
+
+import numpy as np
+import computer
+from computer import *
+
+# the state is a chain of tensors A[l, d, r], one per subsystem, with
+# bonds of size at most chi between neighbours. it is kept in canonical
+# form around a center site (everything left of it is left-orthonormal,
+# everything right of it right-orthonormal), so the norm and single-site
+# probabilities can be read off the center, and cutting bonds with an
+# SVD throws away as little as possible.
+#
+# each cut drops the singular values past chi (or below cutoff relative
+# to the largest); the discarded weight is added up in trunc_error, which
+# bounds how far (in 1 - fidelity, to first order) the state has drifted
+# from the exact one. if it isn't small, don't trust the results.
+
+class MPSQC(QC):
+    joint_measure = False
+    def __init__(self, dims, chi=64, cutoff=1e-12, dtype=None):
+        try: dims = list(dims)
+        except TypeError: dims = [2] * dims
+        self.dims = dims
+        self.ndims = len(self.dims)
+        self.chi = chi
+        self.cutoff = cutoff
+        self.dtype = computer.default_dtype if dtype is None else dtype
+        self.tensors = []
+        for d in dims:
+            A = np.zeros((1, d, 1), dtype=self.dtype)
+            A[0, 0, 0] = 1
+            self.tensors.append(A)
+        self.center = 0
+        self.trunc_error = 0.0
+    def bond_dims(self): return [A.shape[2] for A in self.tensors[:-1]]
+    def _move(self, k):
+        # shift the canonical center to site k with QR decompositions
+        ts = self.tensors
+        while self.center < k:
+            c = self.center
+            l, d, r = ts[c].shape
+            Q, R = np.linalg.qr(ts[c].reshape((l * d, r)))
+            ts[c] = Q.reshape((l, d, Q.shape[1]))
+            ts[c + 1] = np.tensordot(R, ts[c + 1], (1, 0))
+            self.center += 1
+        while self.center > k:
+            c = self.center
+            l, d, r = ts[c].shape
+            Q, R = np.linalg.qr(ts[c].reshape((l, d * r)).T)
+            ts[c] = Q.T.reshape((Q.shape[1], d, r))
+            ts[c - 1] = np.tensordot(ts[c - 1], R.T, (2, 0))
+            self.center -= 1
+    def _cut(self, S):
+        # how many singular values to keep; adds the rest to trunc_error
+        w = S ** 2
+        keep = min(self.chi, max(1, np.count_nonzero(S > self.cutoff * S[0])))
+        lost = w[keep:].sum() / w.sum()
+        self.trunc_error += lost
+        return keep, np.sqrt(1 - lost)
+    def _split(self, theta, s):
+        # write theta[l, d_s, ..., d_{s+k-1}, r] back as sites s.., sweeping
+        # right, so the center ends up on the last one
+        k = theta.ndim - 2
+        for i in range(s, s + k - 1):
+            l, d = theta.shape[:2]
+            rest = theta.shape[2:]
+            U, S, Vh = np.linalg.svd(theta.reshape((l * d, -1)),
+                full_matrices=False)
+            keep, norm = self._cut(S)
+            self.tensors[i] = U[:, :keep].reshape((l, d, keep))
+            theta = (S[:keep, np.newaxis] / norm * Vh[:keep]).reshape(
+                (keep,) + rest)
+        self.tensors[s + k - 1] = theta.astype(self.dtype)
+        self.center = s + k - 1
+    def _merge(self, s, k):
+        # contract sites s..s+k-1 into one tensor [l, d..., r]
+        self._move(s)
+        theta = self.tensors[s]
+        for i in range(s + 1, s + k):
+            theta = np.tensordot(theta, self.tensors[i], (-1, 0))
+        return theta
+    def _swap(self, i):
+        # exchange sites i and i + 1
+        theta = self._merge(i, 2).transpose((0, 2, 1, 3))
+        self.dims[i], self.dims[i + 1] = self.dims[i + 1], self.dims[i]
+        self._split(theta, i)
+    def _apply(self, gate, s, k):
+        # gate on the k adjacent sites starting at s
+        if k == 1:
+            self.tensors[s] = np.moveaxis(
+                np.tensordot(self.tensors[s], gate, (1, 0)), -1, 1)
+            return
+        theta = self._merge(s, k)
+        theta = np.tensordot(theta, gate, (lrange(1, k + 1), lrange(k)))
+        self._split(np.moveaxis(theta, 1, -1), s)
+    def gate(self, gate, on):
+        verify_gate(gate)
+        try: on = list(on)
+        except TypeError: on = [on]
+        gate = np.asarray(gate, dtype=self.dtype)
+        # route the targets next to each other (in the order of on) with
+        # swaps, apply the gate there, then swap everything back
+        start = min(on)
+        order = lrange(self.ndims)
+        swaps = []
+        for i, n in enumerate(on):
+            cur = order.index(n)
+            while cur > start + i:
+                self._swap(cur - 1)
+                order[cur - 1], order[cur] = order[cur], order[cur - 1]
+                swaps.append(cur - 1)
+                cur -= 1
+        self._apply(gate, start, len(on))
+        for i in reversed(swaps): self._swap(i)
+    def fourier(self, qubits, inverse=False):
+        qft_gates(self, qubits, inverse)
+    def copy(self):
+        other = MPSQC(self.dims, self.chi, self.cutoff, self.dtype)
+        other.tensors = list(self.tensors)
+        other.center, other.trunc_error = self.center, self.trunc_error
+        return other
+    def kraus(self, ops, on, rng=None):
+        # like QC.kraus, with each K tried on a copy. gates keep the
+        # canonical form, so the norm of the state is that of the center
+        try: on = list(on)
+        except TypeError: on = [on]
+        u = get_rng(rng).uniform()
+        acc = 0.0
+        self._move(min(on))
+        for i, K in enumerate(ops):
+            other = self.copy()
+            other.gate(K, on)
+            A = other.tensors[other.center]
+            p = np.vdot(A, A).real
+            if p == 0: continue
+            acc += p
+            other.tensors[other.center] = A / np.sqrt(p)
+            pick, new = i, other
+            if acc >= u: break
+        self.__dict__.update(new.__dict__)
+        return pick
+    def marginal(self, ns):
+        # contract <psi|psi> from the first to the last of ns, keeping the
+        # diagonal of each site in ns. outside that range the canonical
+        # form makes the environments identities
+        ns = list(ns)
+        lo, hi = min(ns), max(ns)
+        self._move(lo)
+        E = np.eye(self.tensors[lo].shape[0], dtype=self.dtype)
+        for i in range(lo, hi + 1):
+            A = self.tensors[i]
+            T = np.tensordot(E, A, (-2, 0))
+            if i in ns: E = np.einsum("...asc,asd->...scd", T, A.conj())
+            else: E = np.einsum("...asc,asd->...cd", T, A.conj())
+        pdf = np.einsum("...cc->...", E).real.astype(float)
+        kept = sorted(ns)
+        return np.transpose(pdf, [kept.index(n) for n in ns])
+    def reduced_density(self, ns):
+        # the same contraction as marginal, keeping separate ket and bra
+        # indices for each site in ns
+        ns = list(ns)
+        lo, hi = min(ns), max(ns)
+        self._move(lo)
+        E = np.eye(self.tensors[lo].shape[0], dtype=self.dtype)
+        for i in range(lo, hi + 1):
+            A = self.tensors[i]
+            T = np.tensordot(E, A, (-2, 0))
+            if i in ns: E = np.einsum("...asc,atd->...stcd", T, A.conj())
+            else: E = np.einsum("...asc,asd->...cd", T, A.conj())
+        rho = np.einsum("...cc->...", E)
+        kept = sorted(ns)
+        perm = ([2 * kept.index(n) for n in ns]
+            + [2 * kept.index(n) + 1 for n in ns])
+        D = product(self.dims[n] for n in ns)
+        return np.transpose(rho, perm).reshape((D, D))
+    def probs(self, out=None):
+        data = self.to_dense()
+        if out is None: return np.abs(data) ** 2
+        np.abs(data, out=out)
+        return np.square(out, out=out)
+    def _draw(self, pdf, rng):
+        # one outcome per row of pdf
+        cdf = pdf.cumsum(axis=1)
+        u = rng.uniform(size=len(pdf)) * cdf[:, -1]
+        return np.minimum((cdf < u[:, np.newaxis]).sum(axis=1),
+            pdf.shape[1] - 1)
+    def sample(self, ns, shots=1, rng=None, counts=False):
+        # sweeps left to right drawing every site from the first to the
+        # last of ns conditioned on the ones before it, for all shots at
+        # once: O(shots chi^2) per site, so ns can be wide
+        try: ns = list(ns)
+        except TypeError: ns = [ns]
+        rng = get_rng(rng)
+        lo, hi = min(ns), max(ns)
+        self._move(lo)
+        # left of the center is an orthonormal basis, so first pick which
+        # basis vector (by its weight) and carry on from there
+        A = self.tensors[lo]
+        w = (np.abs(A) ** 2).sum(axis=(1, 2))
+        v = np.eye(len(w), dtype=self.dtype)[
+            self._draw(np.tile(w, (shots, 1)), rng)]
+        res = np.zeros((shots, hi - lo + 1), dtype=int)
+        rows = np.arange(shots)
+        for i in range(lo, hi + 1):
+            psi = np.tensordot(v, self.tensors[i], (1, 0))
+            sel = self._draw((np.abs(psi) ** 2).sum(axis=2), rng)
+            res[:, i - lo] = sel
+            v = psi[rows, sel]
+            v /= np.linalg.norm(v, axis=1)[:, np.newaxis]
+        res = res[:, [n - lo for n in ns]]
+        if not counts: return res
+        hist = np.zeros([self.dims[n] for n in ns], dtype=int)
+        np.add.at(hist, tuple(res.T), 1)
+        return hist
+    def measure_as(self, n, k, p=None):
+        self._move(n)
+        A = self.tensors[n]
+        if p is None: p = np.sum(np.abs(A[:, k]) ** 2)
+        if p == 0: raise ValueError("invalid measurement")
+        B = np.zeros_like(A)
+        B[:, k] = A[:, k] / np.sqrt(p)
+        self.tensors[n] = B
+        return p
+    def measure(self, n):
+        self._move(n)
+        pdf = (np.abs(self.tensors[n]) ** 2).sum(axis=(0, 2))
+        sel = np.random.choice(self.dims[n], p=pdf / pdf.sum())
+        p = pdf[sel]
+        self.measure_as(n, sel, p=p)
+        return (p, sel)
+    def to_dense(self):
+        # only for registers small enough to hold densely
+        data = self.tensors[0]
+        for A in self.tensors[1:]: data = np.tensordot(data, A, (-1, 0))
+        return data.reshape(self.dims)
+    def to_qc(self): return QC(None, data=self.to_dense())
+    def load(self, data):
+        # start from the dense state data (shaped like dims)
+        self.tensors = [None] * self.ndims
+        self._split(np.asarray(data, dtype=self.dtype)[np.newaxis, ...,
+            np.newaxis], 0)
+    def entries(self, thresh=0.0, top=None):
+        return self.to_qc().entries(thresh, top)
+    def stream(self, thresh=0.0, chunk=2**20):
+        return self.to_qc().stream(thresh, chunk)
+    def equal_superposition(self, states):
+        qc = QC(self.dims, dtype=self.dtype)
+        qc.equal_superposition(states)
+        self.load(qc.data)
+    def checkpoint(self, path): np.save(path, self.to_dense())
+
+per_subsystem(MPSQC)
+MPSQC.ma = MPSQC.measure_as
+MPSQC.m = MPSQC.measure
+MPSQC.g = MPSQC.gate
+MPSQC.s = MPSQC.sample
+MPSQC.k = MPSQC.kraus
+MPSQC.esp = MPSQC.equal_superposition
@@ -0,0 +1,196 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Density matrix simulation with noise channels
+
+from __future__ import print_function, division
+
+import sys
+import numpy as np
+import computer
+from computer import *
+
+# a channel is a list of Kraus operators K (sum K^dag K = I), written as
+# tensors in the same layout as gates, so single-qubit ones are qbgates
+
+def depolarizing(p):
+    # with probability p the qubit is replaced by the maximally mixed state
+    return [r(1 - 3 * p / 4) * I, r(p / 4) * X, r(p / 4) * Y, r(p / 4) * Z]
+
+def amplitude_damping(gamma):
+    return [qbgate(1, 0, 0, r(1 - gamma)), qbgate(0, r(gamma), 0, 0)]
+
+def phase_damping(lam):
+    return [qbgate(1, 0, 0, r(1 - lam)), qbgate(0, 0, 0, r(lam))]
+
+def bit_flip(p): return [r(1 - p) * I, r(p) * X]
+def phase_flip(p): return [r(1 - p) * I, r(p) * Z]
+
+def noisy_bell(e):
+    # on one half of an EPR pair this gives quantum.nbp(e): with probability
+    # e/2 it becomes Z|epr>, and epr and Z|epr> mixed equally is
+    # (|00><00| + |11><11|) / 2
+    return phase_flip(e / 2)
+
+def superoperator(ops):
+    # sum_k K (x) conj(K), as one gate on the ket and then bra axes of the
+    # targets, so a channel costs a single pass over rho
+    dims = gate_dims(ops[0])
+    D = product(dims)
+    S = 0
+    for K in ops:
+        K = np.asarray(K).reshape((D, D))
+        S = S + np.einsum("ac,bd->abcd", K, K.conj())
+    return S.reshape(dims * 4)
+
+# rho is kept as a tensor with one ket axis and one bra axis per subsystem
+# (all ket axes first), so a gate is the usual kernel on the ket axes and
+# its conjugate on the bra axes: O(4^n) work, never a 2^n x 2^n matmul.
+# flattening the ket and bra axes gives the matrix as in quantum.py
+
+class DensityQC(QC):
+    # noise: a channel applied to each target after every gate
+    def __init__(self, dims, inplace=False, data=None, dtype=None,
+            noise=None):
+        # data: start from this rho, as a tensor (dims taken from its
+        # shape) or, if dims is given, anything that reshapes to one
+        if data is None:
+            try: dims = list(dims)
+            except TypeError: dims = [2] * dims
+            data = np.zeros(dims * 2,
+                dtype=computer.default_dtype if dtype is None else dtype)
+            data[(0,) * 2 * len(dims)] = 1
+        elif dims is None: dims = list(data.shape[:data.ndim // 2])
+        else:
+            try: dims = list(dims)
+            except TypeError: dims = [2] * dims
+            data = data.reshape(dims * 2)
+        self.dims = dims
+        self.ndims = len(dims)
+        self.data = data
+        self.inplace = inplace
+        self.buf = np.empty_like(self.data) if inplace else None
+        self.noise = None if noise is None else superoperator(noise)
+        self._marginals = {}
+    def _bra(self, on): return [self.ndims + x for x in on]
+    def gate(self, gate, on):
+        try: on = list(on)
+        except TypeError: on = [on]
+        QC.gate(self, gate, on)
+        QC.gate(self, gate.conj(), self._bra(on))
+        if self.noise is not None:
+            for x in on: QC.gate(self, self.noise, [x] + self._bra([x]))
+    def fourier(self, qubits, inverse=False):
+        # F rho F^dag: the QFT on the ket axes and its conjugate (the other
+        # direction) on the bra axes. with noise, gate by gate instead, so
+        # each gate gets its channel
+        qubits = list(qubits)
+        if self.noise is not None: return qft_gates(self, qubits, inverse)
+        if not qubits: return
+        for axes, inv in [(qubits, inverse), (self._bra(qubits), not inverse)]:
+            res = apply_fourier(self.data, axes, inv, out=self.buf)
+            if res is self.buf: self.buf = self.data
+            self.data = res
+        self._marginals = {}
+    def kraus(self, ops, on, rng=None):
+        # apply the channel with Kraus operators ops to the targets. (rng
+        # is only there so programs written for QC.kraus run unchanged;
+        # nothing is random here)
+        try: on = list(on)
+        except TypeError: on = [on]
+        QC.gate(self, superoperator(ops), on + self._bra(on))
+    def matrix(self):
+        D = product(self.dims)
+        return self.data.reshape((D, D))
+    def probs(self, out=None):
+        p = self.matrix().diagonal().real.reshape(self.dims)
+        if out is None: return p.copy()
+        out[...] = p
+        return out
+    def _probs(self): return self.probs()
+    def entries(self, thresh=0.0, top=None):
+        # the diagonal of rho stands in for the amplitudes
+        probs = self.probs().ravel()
+        sel = select(probs, thresh, top)
+        return sel, probs[sel], probs[sel].astype(self.data.dtype)
+    def stream(self, thresh=0.0, chunk=2**20): yield self.entries(thresh)
+    def reduced_density(self, ns):
+        # partial trace over everything but ns, as in quantum.traceout
+        ns = list(ns)
+        n = self.ndims
+        bras = [n + x if x in ns else x for x in range(n)]
+        D = product(self.dims[x] for x in ns)
+        return np.einsum(self.data, lrange(n) + bras,
+            ns + [n + x for x in ns]).reshape((D, D))
+    def purity(self): return np.vdot(self.data, self.data).real
+    def measure_as(self, n, k, p=None):
+        # like QC.measure_as, keeping the slice on both the ket and the bra
+        try: ns, ks = list(n), list(k)
+        except TypeError: ns, ks = [n], [k]
+        if p is None: p = self.marginal(ns)[tuple(ks)]
+        if p == 0: raise ValueError("invalid measurement")
+        sel = [slice(None)] * 2 * self.ndims
+        for x, v in zip(ns, ks): sel[x] = sel[self.ndims + x] = v
+        sel = tuple(sel)
+        keep = self.data[sel] * float(1 / p)
+        if self.inplace: self.data[...] = 0
+        else: self.data = np.zeros_like(self.data)
+        self.data[sel] = keep
+        self._marginals = {}
+        return p
+    def dump(self, f=None, thresh=0.0, amps=False, chunk=2**20):
+        # with amps (so also for fa), the entries of rho with |value|^2 >=
+        # thresh, as "row col value" lines, a block of rows at a time
+        if not amps: return QC.dump(self, f, thresh, amps, chunk)
+        if isinstance(f, str):
+            with open(f, "w") as fh: return self.dump(fh, thresh, amps, chunk)
+        if f is None: f = sys.stdout
+        mat = self.matrix()
+        step = max(1, chunk // len(mat))
+        for start in range(0, len(mat), step):
+            blk = mat[start:start + step]
+            rows, cols = np.nonzero(np.abs(blk) ** 2 >= thresh)
+            if not len(rows): continue
+            f.write("".join(a + " " + b + " " + show_complex(z) + "\n"
+                for a, b, z in zip(self.bitstrings(rows + start),
+                    self.bitstrings(cols), blk[rows, cols])))
+    def equal_superposition(self, states):
+        val = 1 / len(states)
+        self.data[:] = 0
+        for a in states:
+            for b in states: self.data[tuple(a) + tuple(b)] = val
+        self._marginals = {}
+
+DensityQC.ma = DensityQC.measure_as
+DensityQC.g = DensityQC.gate
+DensityQC.k = DensityQC.kraus
+DensityQC.esp = DensityQC.equal_superposition
+
+# quantum trajectories
+# for registers too big for rho: run the circuit on pure states, with
+# qc.kraus picking one Kraus operator at random each time, and average.
+# each trajectory needs O(2^n) memory instead of O(4^n)
+
+def trajectories(program, dims, ns, trajs=1000, batch=256, shots=0,
+        seed=None, z=1.96, dtype=None):
+    # program(qc, rng) applies gates and channels (qc.kraus(ops, on, rng))
+    # to qc, a BatchQC of up to batch trajectories. returns a dict with the
+    # distribution of ns averaged over trajs trajectories, the half-width
+    # of its z-sigma confidence interval, and (with shots > 0) a histogram
+    # of shots samples per trajectory. everything is drawn from one
+    # generator seeded with seed, so runs are reproducible
+    rng = np.random.default_rng(seed)
+    tot = sq = counts = 0
+    done = 0
+    while done < trajs:
+        qc = BatchQC(min(batch, trajs - done), dims, dtype)
+        program(qc, rng)
+        pdf = qc.marginal(ns)
+        tot = tot + pdf.sum(axis=0)
+        sq = sq + (pdf ** 2).sum(axis=0)
+        if shots: counts = counts + qc.sample(ns, shots, rng,
+            counts=True).sum(axis=0)
+        done += qc.batch
+    mean = tot / trajs
+    var = np.maximum(sq / trajs - mean ** 2, 0) * trajs / max(trajs - 1, 1)
+    return {"probs": mean, "ci": z * np.sqrt(var / trajs),
+        "counts": counts if shots else None}
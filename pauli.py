@@ -0,0 +1,212 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Expectation values of observables written as sums of Pauli strings
+
+from __future__ import print_function, division
+
+import collections
+import numpy as np
+from computer import *
+
+# a Pauli string like "XIZY" has one letter per qubit (qubit 0 first). up
+# to a phase it is X^x Z^z for bit masks x and z (Y = i X Z), so
+#   <psi|P|psi> = i^(#Y) sum_b conj(psi[b ^ x]) (-1)^(z . b) psi[b]
+# i.e. flip the axes in x, multiply by the state, and sum with signs.
+# terms with the same x share the flip and the product, and each term is
+# then one signed sum over it; with many terms on one x, a Walsh-Hadamard
+# transform of the product gives every z at once. no 2^n x 2^n matrix is
+# ever built.
+
+class PauliSum:
+    # terms: a dict {string: coefficient}, an iterable of
+    # (coefficient, string) pairs, or a single string
+    def __init__(self, terms):
+        if isinstance(terms, str): terms = {terms: 1}
+        if isinstance(terms, dict): terms = [(c, s) for s, c in terms.items()]
+        self.terms = collections.OrderedDict()
+        for c, s in terms:
+            s = s.upper()
+            if set(s) - set("IXYZ"): raise ValueError("bad Pauli string")
+            self.terms[s] = self.terms.get(s, 0) + c
+        ns = set(len(s) for s in self.terms)
+        if len(ns) > 1: raise ValueError("Pauli strings of different lengths")
+        self.n = ns.pop() if ns else 0
+    def __len__(self): return len(self.terms)
+    def __add__(self, other):
+        other = PauliSum(other) if not isinstance(other, PauliSum) else other
+        return PauliSum([(c, s) for s, c in self.terms.items()]
+            + [(c, s) for s, c in other.terms.items()])
+    def __mul__(self, c):
+        return PauliSum([(c * v, s) for s, v in self.terms.items()])
+    __rmul__ = __mul__
+    def __repr__(self):
+        return "PauliSum({})".format(dict(self.terms))
+    def matrix(self):
+        # the 2^n x 2^n matrix, for small n only (and for checking)
+        mats = {"I": I, "X": X, "Y": Y, "Z": Z}
+        res = 0
+        for s, c in self.terms.items():
+            m = np.ones((1, 1))
+            for ch in s: m = np.kron(m, mats[ch].T)
+            res = res + c * m
+        return res
+
+def masks(s):
+    # (x, z, number of Ys) of a Pauli string; x and z are tuples of bools
+    return (tuple(ch in "XY" for ch in s), tuple(ch in "ZY" for ch in s),
+        s.count("Y"))
+
+def _zsum(v, z):
+    # sum_b v[b] (-1)^(z . b) over the last len(z) axes, one axis at a
+    # time from the last (each step halves v)
+    for bit in reversed(z):
+        v = v[..., 0] - v[..., 1] if bit else v[..., 0] + v[..., 1]
+    return v
+
+def _walsh(v, n):
+    # _zsum for every z at once: Walsh-Hadamard transform of the last n
+    # axes, result indexed by z
+    for j in range(n):
+        ax = v.ndim - n + j
+        a = np.take(v, 0, axis=ax)
+        b = np.take(v, 1, axis=ax)
+        v = np.stack([a + b, a - b], axis=ax)
+    return v
+
+def _products(data, n, density, x):
+    # v[..., b] = conj(psi[b ^ x]) psi[b], or rho[b, b ^ x] for a density
+    # matrix (its trace against P is the same sum)
+    flip = [i for i, bit in enumerate(x) if bit]
+    if density:
+        rho = np.flip(data, [n + i for i in flip]) if flip else data
+        return np.einsum(rho, lrange(n) * 2, lrange(n))
+    lead = data.ndim - n
+    other = np.flip(data, [lead + i for i in flip]) if flip else data
+    return other.conj() * data
+
+def _dense_values(qc, strings):
+    # <P> for each string, straight from qc.data (a state, a batch of
+    # states or a density matrix), grouped by x as described above
+    n, density = qc.ndims, hasattr(qc, "matrix")
+    groups = collections.OrderedDict()
+    for s in strings:
+        x, z, ny = masks(s)
+        groups.setdefault(x, collections.OrderedDict())[s] = (z, ny)
+    vals = {}
+    for x, terms in groups.items():
+        v = _products(qc.data, n, density, x)
+        if len(terms) > n:
+            W = _walsh(v, n)
+            sums = dict((s, W[(Ellipsis,) + tuple(int(b) for b in z)])
+                for s, (z, ny) in terms.items())
+        else: sums = dict((s, _zsum(v, z)) for s, (z, ny) in terms.items())
+        for s, (z, ny) in terms.items(): vals[s] = (1j ** ny * sums[s]).real
+    return vals
+
+def _mapped_values(qc, strings):
+    # the same for a MappedQC, a chunk at a time: the chunks keep the
+    # flipped axes whole, and within a chunk the axes split off are fixed,
+    # so their part of (-1)^(z . b) is just a sign
+    groups = collections.OrderedDict()
+    for s in strings:
+        x, z, ny = masks(s)
+        groups.setdefault(x, collections.OrderedDict())[s] = (z, ny)
+    vals = dict((s, 0.0) for s in strings)
+    for x, terms in groups.items():
+        flip = [i for i, bit in enumerate(x) if bit]
+        for split, idx, blk in qc.chunks(flip):
+            keep = [i for i in range(qc.ndims) if i not in split]
+            v = _products(np.array(blk), len(keep), False,
+                [x[i] for i in keep])
+            for s, (z, ny) in terms.items():
+                sign = (-1) ** sum(int(z[i]) * b for i, b in zip(split, idx))
+                vals[s] += sign * (1j ** ny
+                    * _zsum(v, [z[i] for i in keep])).real
+    return vals
+
+# registers that don't hold amplitudes densely work string by string, and
+# never build anything of size 2^n
+
+def _bitmask(bits):
+    # bits (qubit 0 first) as a flat-index mask
+    return sum(1 << (len(bits) - 1 - i) for i, bit in enumerate(bits) if bit)
+
+def _parity(v):
+    # parity of the set bits of each entry of the int64 array v
+    for shift in (32, 16, 8, 4, 2, 1): v = v ^ (v >> shift)
+    return v & 1
+
+def _sparse_value(qc, s):
+    # the stored indices b whose partner b ^ x is also stored
+    x, z, ny = masks(s)
+    part = qc.idx ^ _bitmask(x)
+    pos = np.minimum(np.searchsorted(qc.idx, part), len(qc.idx) - 1)
+    hit = qc.idx[pos] == part
+    sign = 1 - 2 * _parity(qc.idx[hit] & _bitmask(z))
+    return (1j ** ny * np.sum(qc.amp[pos[hit]].conj() * sign
+        * qc.amp[hit])).real
+
+def _mps_value(qc, s):
+    # <psi|P|psi> by transfer matrices from the first to the last letter
+    # that isn't I; outside that the canonical form makes the
+    # environments identities
+    sites = [i for i, ch in enumerate(s) if ch != "I"]
+    if not sites: return 1.0
+    paulis = {"X": X, "Y": Y, "Z": Z}
+    lo, hi = sites[0], sites[-1]
+    qc._move(lo)
+    E = np.eye(qc.tensors[lo].shape[0], dtype=qc.dtype)
+    for i in range(lo, hi + 1):
+        A = qc.tensors[i]
+        B = A if s[i] == "I" else np.moveaxis(
+            np.tensordot(A, paulis[s[i]], (1, 0)), -1, 1)
+        E = np.einsum("asc,asd->cd", np.tensordot(E, B, (0, 0)), A.conj())
+    return np.trace(E).real
+
+def _stabilizer_value(qc, s):
+    # a Pauli string that anticommutes with a stabilizer has <P> = 0;
+    # otherwise +-P is the product of the stabilizers whose destabilizers
+    # anticommute with it, and its sign comes out as in _outcome
+    n = qc.ndims
+    x, z, ny = masks(s)
+    x, z = np.array(x, dtype=bool), np.array(z, dtype=bool)
+    anti = np.logical_xor.reduce((qc.x & z) ^ (qc.z & x), axis=1)
+    if anti[n:].any(): return 0.0
+    rows = np.nonzero(anti[:n])[0] + n
+    if not len(rows): return 1.0
+    tot = 2 * qc.r[rows].sum() + qc._phases(rows)
+    return -1.0 if tot % 4 == 2 else 1.0
+
+def _values(qc, strings):
+    if any(d != 2 for d in qc.dims):
+        raise ValueError("Pauli strings need qubits")
+    if hasattr(qc, "tensors"): value = _mps_value
+    elif hasattr(qc, "amp"): value = _sparse_value
+    elif hasattr(qc, "history"): value = _stabilizer_value
+    elif hasattr(qc, "chunks"): return _mapped_values(qc, strings)
+    else: return _dense_values(qc, strings)
+    return dict((s, value(qc, s)) for s in strings)
+
+def expectation(qc, obs):
+    # <obs> on qc (any register type; BatchQC gives one value per member).
+    # obs is a PauliSum or a string; with a list of them, all are
+    # evaluated in one sweep (each distinct string once) and the last
+    # axis of the result runs over obs
+    single = not isinstance(obs, (list, tuple))
+    if single: obs = [obs]
+    obs = [o if isinstance(o, PauliSum) else PauliSum(o) for o in obs]
+    if any(o.n != qc.ndims for o in obs if len(o)):
+        raise ValueError("Pauli strings must have one letter per qubit")
+    strings = list(collections.OrderedDict.fromkeys(
+        s for o in obs for s in o.terms))
+    vals = _values(qc, strings)
+    lead = (np.shape(vals[strings[0]]) if strings
+        else qc.data.shape[:1] if isinstance(qc, BatchQC) else ())
+    res = []
+    for o in obs:
+        tot = np.zeros(lead, dtype=complex if any(np.iscomplexobj(c)
+            for c in o.terms.values()) else float)
+        for s, c in o.terms.items(): tot = tot + c * vals[s]
+        res.append(tot)
+    res = np.stack(res, axis=-1)
+    return np.take(res, 0, axis=-1) if single else res
@@ -7,7 +7,15 @@ from __future__ import print_function, division
 # ! yes, I wrote this in Python 2
 
 import numpy as np
+import caching
 la = np.linalg
+
+# precision of new vectors and matrices (complex64 halves memory, but
+# constants like X below are made at import time with the default)
+default_dtype = complex
+def set_dtype(dtype):
+    global default_dtype
+    default_dtype = dtype
 r = np.sqrt
 r2 = r(2)
 r3 = r(3)
@@ -22,7 +30,7 @@ j = 1.0j
 # ! "[g]lobal [phase]" (just pick the first nonzero),
 # ! "[canon]icalize" (remove global phase),
 # ! "[c]omplex [normalize]", "[v]ector [normalize]"
-def vec(*args): return np.array(args, dtype=complex)
+def vec(*args): return np.array(args, dtype=default_dtype)
 def col(*args): return vec(*args)[:,np.newaxis]
 def row(*args): return vec(*args)[np.newaxis,:]
 def cmag2(x): return (x * x.conjugate()).real
@@ -102,12 +110,12 @@ cos = np.cos
 sin = np.sin
 
 # ! "[t]wo [b]y [t]wo", "[f]our [b]y [f]our", "[sq]uare"
-def tbt(*args): return np.array(args, dtype=complex).reshape((2, 2))
-def fbf(*args): return np.array(args, dtype=complex).reshape((4, 4))
+def tbt(*args): return np.array(args, dtype=default_dtype).reshape((2, 2))
+def fbf(*args): return np.array(args, dtype=default_dtype).reshape((4, 4))
 def sq(*args):
     s = int(np.round(np.sqrt(len(args))))
     assert s ** 2 == len(args)
-    return np.array(args, dtype=complex).reshape((s, s))
+    return np.array(args, dtype=default_dtype).reshape((s, s))
 
 X = tbt(0, 1, 1, 0)
 Y = tbt(0, -1j, 1j, 0)
@@ -120,12 +128,119 @@ T = tbt(1, 0, 0, (1+j)/r2)
 I = tbt(1, 0, 0, 1)
 NOT = X
 
+# constructors like kron and tpow get called on the same few matrices again
+# and again, so they keep an LRU cache (see caching.py), also keyed by
+# default_dtype
+
+def cached(maxsize=256, limit=2**12, keep=2**16):
+    return caching.cached(maxsize, limit, keep, state=lambda: default_dtype)
+
+# matrix functions
+# everything here also takes stacks of matrices (..., d, d). powers and
+# time evolution go through a decomposition mat = V diag(L) W picked by
+# the structure of mat, which is cached, so e.g. evolve(H, t) for many t
+# decomposes H once:
+# - Hermitian: la.eigh, W = V^dag
+# - other normal matrices (unitaries, ...): A = (M + M^dag) / 2 and
+#   B = (M - M^dag) / 2i commute, so la.eigh of A + cB (c generic) almost
+#   always diagonalizes both, and so M; checked, else
+# - anything else: la.eig, W = S^-1 (this fails on defective matrices)
+# integer powers skip all that and use repeated squaring, which works for
+# any matrix
+
+_NORMAL_MIX = 0.5 ** 0.5 + 0.1
+
+def _close_to(x, y, scale):
+    return np.allclose(x, y, rtol=0, atol=1e-12 * max(1.0, scale))
+
+# (decompositions are worth keeping for much bigger matrices than gates)
+@cached(maxsize=16, limit=2**20, keep=3 * 2**20)
+def eigensystem(mat):
+    # (V, L, W) with mat = V diag(L) W
+    mat = np.asarray(mat)
+    h = np.swapaxes(mat, -1, -2).conj()
+    scale = np.abs(mat).max() if mat.size else 1.0
+    if _close_to(mat, h, scale):
+        L, V = la.eigh((mat + h) / 2)
+        return V, L, np.swapaxes(V, -1, -2).conj()
+    if _close_to(np.matmul(mat, h), np.matmul(h, mat), scale ** 2):
+        L, V = la.eigh((mat + h) / 2 + _NORMAL_MIX * (mat - h) / 2j)
+        Vh = np.swapaxes(V, -1, -2).conj()
+        L = np.einsum("...ij,...ji->...i", Vh, np.matmul(mat, V))
+        if _close_to(np.matmul(mat, V), V * L[..., np.newaxis, :], scale):
+            return V, L, Vh
+    L, S = la.eig(mat)
+    if np.any(la.cond(S) > 1e12): raise ValueError("must be diagonalizable")
+    return S, L, la.inv(S)
+
 # ! "[m]atrix [pow]er"
 def mpow(mat, n):
-    L, S = la.eig(mat)
-    Sinv = la.inv(S)
-    assert close(mat, dot(S, np.diag(L), Sinv)), "must be diagonalizable"
-    return dot(S, np.diag(L ** n), la.inv(S))
+    mat = np.asarray(mat)
+    if float(n) == int(n): return la.matrix_power(mat, int(n))
+    V, L, W = eigensystem(mat)
+    L = L.astype(np.result_type(L, complex)) ** n
+    return np.matmul(V * L[..., np.newaxis, :], W)
+
+def evolve(H, t):
+    # exp(-i H t); with an array of times, a stack with the times first
+    V, L, W = eigensystem(H)
+    t = np.asarray(t)
+    L = np.exp(-1j * L * t.reshape(t.shape + (1,) * L.ndim))
+    return np.matmul(V * L[..., np.newaxis, :], W)
+
+# Pade approximants for expm (Higham, "The scaling and squaring method
+# for the matrix exponential revisited", 2005): coefficients of each
+# degree, and the largest 1-norm it's accurate for
+_PADE = {
+    3: [120, 60, 12, 1],
+    5: [30240, 15120, 3360, 420, 30, 1],
+    7: [17297280, 8648640, 1995840, 277200, 25200, 1512, 56, 1],
+    9: [17643225600, 8821612800, 2075673600, 302702400, 30270240,
+        2162160, 110880, 3960, 90, 1],
+    13: [64764752532480000, 32382376266240000, 7771770303897600,
+        1187353796428800, 129060195264000, 10559470521600, 670442572800,
+        33522128640, 1323241920, 40840800, 960960, 16380, 182, 1],
+}
+_PADE_THETA = [(3, 1.495585217958292e-2), (5, 2.539398330063230e-1),
+    (7, 9.504178996162932e-1), (9, 2.097847961257068), (13, 5.371920351148152)]
+
+def _pade(A, m):
+    # (U, V) with exp(A) ~ (V - U)^-1 (V + U)
+    b = _PADE[m]
+    ident = np.broadcast_to(np.eye(A.shape[-1], dtype=A.dtype), A.shape)
+    A2 = np.matmul(A, A)
+    if m == 13:
+        A4 = np.matmul(A2, A2)
+        A6 = np.matmul(A4, A2)
+        U = np.matmul(A6, b[13] * A6 + b[11] * A4 + b[9] * A2)
+        U = np.matmul(A, U + b[7] * A6 + b[5] * A4 + b[3] * A2 + b[1] * ident)
+        V = np.matmul(A6, b[12] * A6 + b[10] * A4 + b[8] * A2)
+        V = V + b[6] * A6 + b[4] * A4 + b[2] * A2 + b[0] * ident
+        return U, V
+    U = b[1] * ident
+    V = b[0] * ident
+    P = ident
+    for k in range(2, m + 1, 2):
+        P = np.matmul(P, A2)
+        U = U + b[k + 1] * P
+        V = V + b[k] * P
+    return np.matmul(A, U), V
+
+def expm(mat):
+    # the matrix exponential by scaling and squaring: exp(M) =
+    # exp(M / 2^s) ^ (2^s), with the lowest degree Pade approximant that is
+    # accurate for the 1-norm (the largest one in the stack)
+    A = np.asarray(mat)
+    A = A.astype(np.result_type(A, float))
+    norm = np.abs(A).sum(axis=-2).max() if A.size else 0.0
+    s = 0
+    for m, theta in _PADE_THETA:
+        if norm <= theta: break
+    else: s = max(0, int(np.ceil(np.log2(norm / theta))))
+    U, V = _pade(A / 2 ** s, m)
+    R = la.solve(V - U, V + U)
+    for i in range(s): R = np.matmul(R, R)
+    return R
 
 # ! "(square) [r]oot of [NOT]"
 rNOT = mpow(NOT, 0.5)
@@ -138,12 +253,13 @@ CNOT = fbf(
 )
 # ! "[c]ontrolled" (gate)
 # later added more general form (was just 2x2 -> 4x4 before)
+@cached()
 def C(gate):
     assert gate.shape[0] == gate.shape[1]
     n = gate.shape[0]
     return vstack(
-        hstack(np.eye(n, dtype=complex), np.zeros((n, n), dtype=complex)),
-        hstack(np.zeros((n, n), dtype=complex), gate),
+        hstack(np.eye(n, dtype=gate.dtype), np.zeros((n, n), dtype=gate.dtype)),
+        hstack(np.zeros((n, n), dtype=gate.dtype), gate),
     )
 SWAP = fbf(
     1,0,0,0,
@@ -157,6 +273,7 @@ swCNOT = run(SWAP, CNOT, SWAP)
 def swC(gate): return run(SWAP, C(gate), SWAP)
 
 # ! "[Kron]ecker"
+@cached()
 def kron(*args):
     args = list(args)
     x = args.pop(0)
@@ -271,19 +388,17 @@ def product(xs):
     return acc
 
 def traceout(mat, *args):
-    is_traced = [x < 0 for x in args]
-    old_dims = [abs(x) for x in args]
-    axes = [abs(x) if x < 0 else 1 for x in args]
-    new_dims = [1 if x < 0 else x for x in args]
-    eyes = [np.eye(x, dtype=complex) for x in old_dims]
-    inds = np.indices(axes).reshape((len(args), -1))
-    new_size = product(new_dims)
-    accum = np.zeros((new_size, new_size), dtype=complex)
-    for p in inds.T:
-        bookend = tprod(*[eye[:,ind:ind+1] if traced else eye
-            for traced, ind, eye in zip(is_traced, p, eyes)])
-        accum += dot(dag(bookend), mat, bookend)
-    return accum
+    # args are the subsystem dims, negated for the ones traced out.
+    # one einsum over mat viewed as a (ket..., bra...) tensor, where each
+    # traced subsystem has the same label on its ket and bra axes
+    dims = [abs(x) for x in args]
+    n = len(dims)
+    keep = [i for i, x in enumerate(args) if x > 0]
+    bras = [i if args[i] < 0 else n + i for i in range(n)]
+    size = product(dims[i] for i in keep)
+    res = np.einsum(mat.reshape(dims * 2), list(range(n)) + bras,
+        keep + [n + i for i in keep])
+    return res.reshape((size, size)).copy()
 
 trace_out = traceout
 partialtrace = traceout
@@ -363,8 +478,10 @@ ms.s1m = sin(pi/8) * ket0 - cos(pi/8) * ket1
 log2 = np.log2
 
 def entropy(*args):
-    assert close(sum(args), 1.0)
-    return -sum(x * log2(x) if x else 0.0 for x in args)
+    p = np.array(args, dtype=float)
+    assert close(p.sum(), 1.0)
+    p = p[p != 0]
+    return -np.sum(p * np.log2(p))
 
 def gghz(n):
     # generalized GHZ
@@ -375,6 +492,7 @@ def fgghz(n):
     return (density(kets(*([0] * n))) + density(kets(*([1] * n)))) / 2
 
 # ! "[t]ensor [pow]er"
+@cached()
 def tpow(mat, n):
     assert n >= 1
     curr = mat
@@ -400,15 +518,14 @@ def clstr(arr):
 def pclstr(arr): print(clstr(arr))
 
 def QFT(d):
-    arr = np.zeros((d, d), dtype=complex)
-    for p in range(d):
-        for q in range(d):
-            arr[p][q] = 1/r(d) * np.exp(2*pi*j*p*q/d)
-    return arr
+    # entries are the d-th roots of unity, indexed by p*q mod d
+    # (which also keeps the phases accurate for big d)
+    roots = (1/r(d) * np.exp(2*pi*j*np.arange(d)/d)).astype(default_dtype)
+    return roots[np.outer(np.arange(d), np.arange(d)) % d]
 
 # we need some bigger matrices
-def diag(*arr): return np.array(np.diag(arr), dtype=complex)
-def I_(n): return np.eye(n, dtype=complex)
+def diag(*arr): return np.array(np.diag(arr), dtype=default_dtype)
+def I_(n): return np.eye(n, dtype=default_dtype)
 # ! "[rand]om [bal]anced (phase oracle)"
 def rand_bal(n):
     # there's actually no reason for this not to work for
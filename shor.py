@@ -0,0 +1,111 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Shor's algorithm end to end: find the period of a^x mod N on a simulated
+# register, then try to factor N with it
+
+from __future__ import print_function, division
+
+import time
+import numpy as np
+from computer import *
+
+# the register is t input qubits (Q = 2^t >= N^2) and m output qubits
+# (2^m >= N). the oracle is a Permutation, so applying it is one gather
+# over the state instead of a dense 2^(t+m) x 2^(t+m) gate. after the QFT
+# every shot is drawn at once, and the classical part (continued
+# fractions, checking candidate periods) runs on arrays of shots.
+
+def modexp_table(N, a, Q):
+    # a^x mod N for x = 0..Q-1, by repeated squaring on all x at once
+    x = np.arange(Q)
+    res = np.ones(Q, dtype=np.int64)
+    base = a % N
+    for bit in range(max(Q - 1, 1).bit_length()):
+        sel = (x >> bit) & 1 == 1
+        res[sel] = res[sel] * base % N
+        base = base * base % N
+    return res
+
+def modexp_oracle(N, a, t, m, table=None):
+    # |x>|y> -> |x>|y xor (a^x mod N)>, on t + m qubits
+    if table is None: table = modexp_table(N, a, 2 ** t)
+    inp, out = np.divmod(np.arange(2 ** (t + m)), 2 ** m)
+    return Permutation(inp * 2 ** m + (out ^ table[inp]), (2,) * (t + m))
+
+def convergents(num, den, limit):
+    # for each fraction num/den, the denominator of its last continued
+    # fraction convergent below limit. exact integer arithmetic, all
+    # fractions at once; takes O(log den) rounds
+    num = np.array(num, dtype=np.int64)
+    den = np.array(den, dtype=np.int64)
+    k1, k2 = np.zeros_like(num), np.ones_like(num)
+    best = np.ones_like(num)
+    live = den != 0
+    while np.any(live):
+        safe = np.where(live, den, 1)
+        a = num // safe
+        num, den = np.where(live, den, num), np.where(live, num - a * safe, 0)
+        k = a * k1 + k2
+        live &= k < limit
+        best = np.where(live, k, best)
+        k1, k2 = np.where(live, k, k1), np.where(live, k1, k2)
+        live &= den != 0
+    return best
+
+def gcd(a, b):
+    while b: a, b = b, a % b
+    return a
+
+def shor(N, a, shots=16, rng=None, verbose=False):
+    # returns a dict with the period of a mod N (or None), nontrivial
+    # factors found from it (or None), the sampled outcomes and the
+    # time spent in each stage
+    times = {}
+    def stage(name, start):
+        times[name] = time.time() - start
+        return time.time()
+    res = {"N": N, "a": a, "period": None, "factors": None, "samples": None,
+        "times": times}
+    g = gcd(a, N)
+    if g != 1:
+        # lucky guess, nothing quantum to do
+        res["factors"] = (g, N // g)
+        return res
+    m = (N - 1).bit_length()
+    t = 2 * m
+    Q = 2 ** t
+    clock = time.time()
+    table = modexp_table(N, a, Q)
+    oracle = modexp_oracle(N, a, t, m, table)
+    clock = stage("oracle", clock)
+    qc = QC(t + m)
+    qc.mg(H, range(t))
+    qc.g(oracle, lrange(t + m))
+    clock = stage("prepare", clock)
+    qft(qc, lrange(t))
+    clock = stage("qft", clock)
+    digits = qc.sample(lrange(t), shots, rng)
+    ls = np.dot(digits, 2 ** np.arange(t - 1, -1, -1))
+    clock = stage("sample", clock)
+    # l/Q ~ k/r, so the convergent denominators divide the period; try
+    # them, small multiples of them, and their lcm
+    dens = np.unique(convergents(ls, Q, N))
+    cands = np.unique(np.concatenate([
+        (dens[:, np.newaxis] * np.arange(1, 5)).ravel(),
+        [np.lcm.reduce(dens)]]))
+    cands = cands[(cands > 0) & (cands < Q)]
+    good = cands[table[cands] == 1]
+    if len(good):
+        r = int(good.min())
+        res["period"] = r
+        if r % 2 == 0 and table[r // 2] != N - 1:
+            h = int(table[r // 2])
+            fs = [gcd(h - 1, N), gcd(h + 1, N)]
+            fs = [f for f in fs if 1 < f < N]
+            if fs: res["factors"] = (fs[0], N // fs[0])
+    stage("classical", clock)
+    res["samples"] = ls
+    if verbose:
+        for name in ["oracle", "prepare", "qft", "sample", "classical"]:
+            print("{:10s}{:.4f}s".format(name, times[name]))
+    return res
@@ -0,0 +1,177 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Sparse simulation, for states with only a few nonzero amplitudes
+
+from __future__ import print_function, division
+
+import numpy as np
+import computer
+from computer import *
+
+# the state is a sorted array of flat indices (C order, like QC.data)
+# and an array of their amplitudes, so a register can have as many
+# qubits as fit in an int64 index as long as few amplitudes are nonzero.
+# once more than `threshold` of all amplitudes are nonzero the register
+# turns itself into a dense QC (and from then on it just is one).
+
+def c_strides(dims):
+    return np.array([product(dims[i+1:]) for i in range(len(dims))],
+        dtype=np.int64)
+
+class SparseQC(QC):
+    joint_measure = False
+    def __init__(self, dims, threshold=0.1, dtype=None):
+        try: dims = list(dims)
+        except TypeError: dims = [2] * dims
+        self.dims = dims
+        self.ndims = len(self.dims)
+        self.size = product(dims)
+        if self.size >= 2 ** 63: raise ValueError("too many amplitudes")
+        self.strides = c_strides(dims)
+        self.threshold = threshold
+        self.dtype = computer.default_dtype if dtype is None else dtype
+        self.idx = np.zeros(1, dtype=np.int64)
+        self.amp = np.ones(1, dtype=self.dtype)
+    def digits(self, ns, idx=None):
+        # (nnz, len(ns)) digits of subsystems ns of each stored index
+        if idx is None: idx = self.idx
+        ns = list(ns)
+        return (idx[:, np.newaxis] // self.strides[ns]
+            % np.array([self.dims[n] for n in ns]))
+    def _offsets(self, on):
+        # flat offset of each basis state of the targets
+        return np.dot(unflatten(np.arange(product(self.dims[n] for n in on)),
+            [self.dims[n] for n in on]), self.strides[on])
+    def _apply(self, idx, amp, gate, on):
+        # returns new (idx, amp), possibly with repeated indices
+        digs = self.digits(on, idx)
+        tin = np.dot(digs, c_strides([self.dims[n] for n in on]))
+        base = idx - np.dot(digs, self.strides[on])
+        if isinstance(gate, Permutation):
+            return base + self._offsets(on)[gate.perm[tin]], amp
+        if isinstance(gate, Diagonal):
+            return idx, amp * gate.diag.ravel()[tin]
+        if isinstance(gate, Controlled):
+            c = gate.controls
+            hit = np.all(digs[:, :c] == 1, axis=1)
+            sub_idx, sub_amp = self._apply(idx[hit], amp[hit], gate.gate, on[c:])
+            return (np.concatenate([idx[~hit], sub_idx]),
+                np.concatenate([amp[~hit], sub_amp]))
+        offs = self._offsets(on)
+        mat = np.asarray(gate).reshape((len(offs), len(offs)))[tin]
+        rows, outs = np.nonzero(mat)
+        return base[rows] + offs[outs], amp[rows] * mat[rows, outs]
+    def _sum(self, idx, amp, tol=1e-14):
+        # sum up repeated indices and drop (numerically) zero amplitudes
+        uniq, inv = np.unique(idx, return_inverse=True)
+        inv = inv.ravel()
+        tot = (np.bincount(inv, amp.real, len(uniq))
+            + 1j * np.bincount(inv, amp.imag, len(uniq)))
+        keep = np.abs(tot) > tol
+        return uniq[keep], tot[keep].astype(self.dtype)
+    def _set(self, idx, amp, tol=1e-14):
+        self.idx, self.amp = self._sum(idx, amp, tol)
+        if len(self.idx) > self.threshold * self.size: self._densify()
+    def _densify(self):
+        data = self.to_dense()
+        self.__class__ = QC
+        self.__dict__.clear()
+        QC.__init__(self, None, data=data)
+    def to_dense(self):
+        data = np.zeros(self.dims, dtype=self.dtype)
+        data.ravel()[self.idx] = self.amp
+        return data
+    def gate(self, gate, on):
+        verify_gate(gate)
+        try: on = list(on)
+        except TypeError: on = [on]
+        self._set(*self._apply(self.idx, self.amp, gate, on))
+    def fourier(self, qubits, inverse=False):
+        qft_gates(self, qubits, inverse)
+    def kraus(self, ops, on, rng=None):
+        # like QC.kraus, with each K applied to the stored amplitudes
+        try: on = list(on)
+        except TypeError: on = [on]
+        u = get_rng(rng).uniform()
+        acc = 0.0
+        for i, K in enumerate(ops):
+            idx, amp = self._sum(*self._apply(self.idx, self.amp, K, on))
+            p = np.vdot(amp, amp).real
+            if p == 0: continue
+            acc += p
+            pick, new = i, (idx, amp / np.sqrt(p))
+            if acc >= u: break
+        self._set(*new)
+        return pick
+    def probs(self, out=None):
+        data = self.to_dense()
+        if out is None: return np.abs(data) ** 2
+        np.abs(data, out=out)
+        return np.square(out, out=out)
+    def marginal(self, ns):
+        ns = list(ns)
+        shape = [self.dims[n] for n in ns]
+        flat = np.dot(self.digits(ns), c_strides(shape))
+        pdf = np.bincount(flat, np.abs(self.amp) ** 2, product(shape))
+        return pdf.reshape(shape)
+    def reduced_density(self, ns):
+        # psi as a (ns, rest) matrix as in QC.reduced_density, with a
+        # column only for each value of the rest that actually occurs
+        ns = list(ns)
+        shape = [self.dims[n] for n in ns]
+        digs = self.digits(ns)
+        rows = np.dot(digs, c_strides(shape))
+        rest, cols = np.unique(self.idx - np.dot(digs, self.strides[ns]),
+            return_inverse=True)
+        M = np.zeros((product(shape), len(rest)), dtype=self.dtype)
+        M[rows, cols.ravel()] = self.amp
+        return np.dot(M, M.conj().T)
+    def sample(self, ns, shots=1, rng=None, counts=False):
+        # like QC.sample, but only over outcomes that actually occur, so
+        # ns can be wide (counts=True still needs the full histogram)
+        try: ns = list(ns)
+        except TypeError: ns = [ns]
+        rng = get_rng(rng)
+        shape = [self.dims[n] for n in ns]
+        uniq, inv = np.unique(np.dot(self.digits(ns), c_strides(shape)),
+            return_inverse=True)
+        pdf = np.bincount(inv.ravel(), np.abs(self.amp) ** 2, len(uniq))
+        hist = rng.multinomial(shots, pdf / pdf.sum())
+        if counts:
+            res = np.zeros(product(shape), dtype=hist.dtype)
+            res[uniq] = hist
+            return res.reshape(shape)
+        flat = rng.permutation(np.repeat(uniq, hist))
+        return unflatten(flat, shape)
+    def measure_as(self, n, k, p=None):
+        if p is None: p = self.marginal([n])[k]
+        if p == 0: raise ValueError("invalid measurement")
+        keep = self.digits([n])[:, 0] == k
+        self.idx = self.idx[keep]
+        self.amp = self.amp[keep] / np.sqrt(p)
+        return p
+    def measure(self, n):
+        pdf = self.marginal([n])
+        sel = np.random.choice(self.dims[n], p=pdf / pdf.sum())
+        p = pdf[sel]
+        self.measure_as(n, sel, p=p)
+        return (p, sel)
+    def entries(self, thresh=0.0, top=None):
+        # only the stored (nonzero) amplitudes
+        probs = np.abs(self.amp) ** 2
+        sel = select(probs, thresh, top)
+        return self.idx[sel], probs[sel], self.amp[sel]
+    def stream(self, thresh=0.0, chunk=2**20): yield self.entries(thresh)
+    def equal_superposition(self, states):
+        idx = np.dot(np.array(states, dtype=np.int64).reshape(
+            (len(states), self.ndims)), self.strides)
+        self._set(idx, np.full(len(idx), 1 / np.sqrt(len(states))))
+    def checkpoint(self, path): np.save(path, self.to_dense())
+
+per_subsystem(SparseQC)
+SparseQC.ma = SparseQC.measure_as
+SparseQC.m = SparseQC.measure
+SparseQC.g = SparseQC.gate
+SparseQC.s = SparseQC.sample
+SparseQC.k = SparseQC.kraus
+SparseQC.esp = SparseQC.equal_superposition
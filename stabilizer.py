@@ -0,0 +1,385 @@
+# Copyright (c) Andrew Li 2018
+# https://github.com/andrew0x4c/cs378h-quantum
+# Stabilizer (Clifford) simulation, following Aaronson and Gottesman,
+# "Improved Simulation of Stabilizer Circuits" (2004)
+
+from __future__ import print_function, division
+
+import numpy as np
+import computer
+from computer import *
+
+# circuits with only H, S, X, Y, Z, CNOT, CZ and SWAP keep the state a
+# stabilizer state, which a tableau of 2n Pauli strings describes in
+# O(n^2) bits instead of 2^n amplitudes. rows 0..n-1 are destabilizers,
+# rows n..2n-1 stabilizers; each row is x and z bits plus a sign bit r.
+#
+# as soon as a gate isn't one of those, the register replays what it has
+# done so far on a dense QC and turns into that QC (like SparseQC does)
+
+Sdg = qbgate(1, 0, 0, -j)
+CZ = np.asarray(C(Z))
+
+_cliffords = [("H", H), ("S", S), ("Sdg", Sdg), ("X", X), ("Y", Y),
+    ("Z", Z), ("I", I), ("CNOT", CNOT), ("CZ", CZ), ("SWAP", SWAP)]
+
+def clifford_name(gate):
+    # name of the tableau update for gate, or None if it isn't one we know
+    if isinstance(gate, Controlled) and gate.controls == 1:
+        inner = np.asarray(gate.gate)
+        if inner.shape == X.shape and np.allclose(inner, X): return "CNOT"
+        if inner.shape == Z.shape and np.allclose(inner, Z): return "CZ"
+    if isinstance(gate, Gate) and len(gate.shape) > 4: return None
+    arr = np.asarray(gate)
+    for name, known in _cliffords:
+        if arr.shape == known.shape and np.allclose(arr, known): return name
+    return None
+
+def is_clifford(circ):
+    return all(clifford_name(gate) is not None for gate, on in circ.ops)
+
+def simulate(circ, n):
+    # runs a Circuit on n qubits, with the tableau if it's Clifford-only
+    qc = StabilizerQC(n) if is_clifford(circ) else QC(n)
+    return circ.run(qc, optimize=not isinstance(qc, StabilizerQC))
+
+_popcount = np.array([bin(i).count("1") for i in range(256)])
+
+def _phase_sum(x1, z1, x2, z2):
+    # total power of i picked up by the single-qubit products of Pauli
+    # rows 1 and 2, given as bits packed with np.packbits
+    pos = (x1 & z1 & z2 & ~x2) | (x1 & ~z1 & z2 & x2) | (~x1 & z1 & x2 & ~z2)
+    neg = (x1 & z1 & x2 & ~z2) | (x1 & ~z1 & z2 & ~x2) | (~x1 & z1 & x2 & z2)
+    return _popcount[pos].sum(axis=-1) - _popcount[neg].sum(axis=-1)
+
+def rowprod(xi, zi, ri, xh, zh, rh):
+    # the "rowsum" of the paper: Pauli row i times row(s) h
+    pack = lambda a: np.packbits(a, axis=-1)
+    tot = (2 * np.asarray(rh, dtype=int) + 2 * int(ri)
+        + _phase_sum(pack(xi), pack(zi), pack(xh), pack(zh)))
+    return xh ^ xi, zh ^ zi, tot % 4 == 2
+
+def _group(x, z, r, sel=None):
+    # products of the Pauli rows (x, z, r) picked by each row of sel
+    # (default: every subset, the i-th subset being the bits of i)
+    k = len(x)
+    if sel is None: sel = unflatten(np.arange(2 ** k), [2] * k).astype(bool)
+    gx = np.zeros((len(sel), x.shape[1]), dtype=bool)
+    gz = np.zeros_like(gx)
+    gr = np.zeros(len(sel), dtype=bool)
+    for i in range(k):
+        hs = np.nonzero(sel[:, i])[0]
+        if len(hs): gx[hs], gz[hs], gr[hs] = rowprod(x[i], z[i], r[i],
+            gx[hs], gz[hs], gr[hs])
+    return gx, gz, gr
+
+class StabilizerQC(QC):
+    joint_measure = False
+    def __init__(self, n):
+        try: n = len(n)
+        except TypeError: pass
+        self.dims = [2] * n
+        self.ndims = n
+        self.x = np.zeros((2 * n, n), dtype=bool)
+        self.z = np.zeros((2 * n, n), dtype=bool)
+        self.r = np.zeros(2 * n, dtype=bool)
+        self.x[np.arange(n), np.arange(n)] = True
+        self.z[np.arange(n, 2 * n), np.arange(n)] = True
+        # for replaying onto a dense QC
+        self.history = []
+    def _h(self, a):
+        self.r ^= self.x[:, a] & self.z[:, a]
+        self.x[:, a], self.z[:, a] = self.z[:, a].copy(), self.x[:, a].copy()
+    def _s(self, a):
+        self.r ^= self.x[:, a] & self.z[:, a]
+        self.z[:, a] ^= self.x[:, a]
+    def _cnot(self, a, b):
+        x, z = self.x, self.z
+        self.r ^= x[:, a] & z[:, b] & ~(x[:, b] ^ z[:, a])
+        x[:, b] ^= x[:, a]
+        z[:, a] ^= z[:, b]
+    def _update(self, name, on):
+        if name == "H": self._h(on[0])
+        elif name == "S": self._s(on[0])
+        elif name == "Sdg":
+            for i in range(3): self._s(on[0])
+        elif name == "X": self.r ^= self.z[:, on[0]]
+        elif name == "Y": self.r ^= self.x[:, on[0]] ^ self.z[:, on[0]]
+        elif name == "Z": self.r ^= self.x[:, on[0]]
+        elif name == "CNOT": self._cnot(on[0], on[1])
+        elif name == "CZ":
+            self._h(on[1])
+            self._cnot(on[0], on[1])
+            self._h(on[1])
+        elif name == "SWAP":
+            a, b = on
+            for arr in (self.x, self.z): arr[:, [a, b]] = arr[:, [b, a]]
+    def gate(self, gate, on):
+        verify_gate(gate)
+        try: on = list(on)
+        except TypeError: on = [on]
+        name = clifford_name(gate)
+        if name is None:
+            self._densify()
+            self.gate(gate, on)
+            return
+        self._update(name, on)
+        self.history.append(("g", gate, on))
+    def fourier(self, qubits, inverse=False):
+        qft_gates(self, qubits, inverse)
+    def kraus(self, ops, on, rng=None):
+        # like QC.kraus. if every K is c U for a Clifford U (as in
+        # depolarizing or bit_flip), K is picked with probability |c|^2
+        # whatever the state, and U applied to the tableau; otherwise the
+        # register goes dense, as for a non-Clifford gate
+        try: on = list(on)
+        except TypeError: on = [on]
+        weights, gates = [], []
+        for K in ops:
+            arr = np.asarray(K)
+            w = np.vdot(arr, arr).real / product(gate_dims(arr))
+            U = arr / np.sqrt(w) if w > 0 else arr
+            if w > 0 and clifford_name(U) is None:
+                self._densify()
+                return self.kraus(ops, on, rng)
+            weights.append(w)
+            gates.append(U)
+        u = get_rng(rng).uniform()
+        acc = 0.0
+        for i, w in enumerate(weights):
+            if w == 0: continue
+            acc += w
+            pick = i
+            if acc >= u: break
+        self.gate(gates[pick], on)
+        return pick
+    def _rowsum(self, hs, i):
+        # rows hs *= row i, for several hs at once
+        self.x[hs], self.z[hs], self.r[hs] = rowprod(self.x[i], self.z[i],
+            self.r[i], self.x[hs], self.z[hs], self.r[hs])
+    def _outcome(self, a):
+        # (None, row) if measuring a is random, else (outcome, None)
+        n = self.ndims
+        rows = np.nonzero(self.x[n:, a])[0]
+        if len(rows): return None, rows[0] + n
+        # deterministic: multiply together the stabilizers whose
+        # destabilizers anticommute with Z_a; the sign is the outcome.
+        # the phases just add up, so do all the products at once, each
+        # row against the product of the rows before it
+        rows = np.nonzero(self.x[:n, a])[0] + n
+        tot = 2 * self.r[rows].sum() + self._phases(rows)
+        return int(tot % 4 == 2), None
+    def _phases(self, rows):
+        # power of i picked up multiplying rows together, in order
+        xs = np.packbits(self.x[rows], axis=-1)
+        zs = np.packbits(self.z[rows], axis=-1)
+        px = np.bitwise_xor.accumulate(xs, axis=0)[:-1]
+        pz = np.bitwise_xor.accumulate(zs, axis=0)[:-1]
+        return _phase_sum(xs[1:], zs[1:], px, pz).sum()
+    def _collapse(self, a, p, k):
+        # random measurement of a came out as k
+        n = self.ndims
+        hs = np.nonzero(self.x[:, a])[0]
+        hs = hs[hs != p]
+        if len(hs): self._rowsum(hs, p)
+        self.x[p - n], self.z[p - n], self.r[p - n] = \
+            self.x[p], self.z[p], self.r[p]
+        self.x[p] = False
+        self.z[p] = False
+        self.z[p, a] = True
+        self.r[p] = k
+    def measure_as(self, n, k, p=None):
+        out, row = self._outcome(n)
+        if out is None:
+            self._collapse(n, row, k)
+            prob = 0.5
+        elif out != k: raise ValueError("invalid measurement")
+        else: prob = 1.0
+        self.history.append(("m", n, k))
+        return prob
+    def measure(self, n):
+        out, row = self._outcome(n)
+        if out is not None:
+            self.history.append(("m", n, out))
+            return (1.0, out)
+        sel = np.random.randint(2)
+        self._collapse(n, row, sel)
+        self.history.append(("m", n, sel))
+        return (0.5, sel)
+    def copy(self):
+        other = StabilizerQC(self.ndims)
+        other.x, other.z, other.r = self.x.copy(), self.z.copy(), self.r.copy()
+        other.history = list(self.history)
+        return other
+    def _affine(self, ns):
+        # one pass measuring ns on a copy of the tableau, leaving each
+        # random outcome as a free bit. the signs only ever get XORed, so
+        # they (and every outcome) are affine functions of the free bits
+        # over GF(2): returns them as rows [constant, coefficients] of a
+        # (len(ns), len(ns) + 1) array. O(len(ns) n^2)
+        n, m = self.ndims, len(ns)
+        other = self.copy()
+        sign = np.zeros((2 * n, m + 1), dtype=bool)
+        sign[:, 0] = other.r
+        form = np.zeros((m, m + 1), dtype=bool)
+        for i, a in enumerate(ns):
+            rows = np.nonzero(other.x[n:, a])[0]
+            if not len(rows):
+                rows = np.nonzero(other.x[:n, a])[0] + n
+                form[i] = np.bitwise_xor.reduce(sign[rows], axis=0)
+                form[i, 0] ^= other._phases(rows) % 4 == 2
+                continue
+            # as in _collapse, with the new sign the free bit i
+            p = rows[0] + n
+            hs = np.nonzero(other.x[:, a])[0]
+            hs = hs[hs != p]
+            if len(hs):
+                other.x[hs], other.z[hs], flip = rowprod(other.x[p],
+                    other.z[p], False, other.x[hs], other.z[hs], False)
+                sign[hs] ^= sign[p]
+                sign[hs, 0] ^= flip
+            other.x[p - n], other.z[p - n] = other.x[p], other.z[p]
+            sign[p - n] = sign[p]
+            other.x[p] = False
+            other.z[p] = False
+            other.z[p, a] = True
+            sign[p] = False
+            sign[p, i + 1] = True
+            form[i, i + 1] = True
+        return form
+    def _support(self, ns):
+        # (base, dirs): the outcomes of ns are base XOR any sum of rows of
+        # dirs, all equally likely. (each random outcome brings in its own
+        # free bit, so the rows are independent and the sums distinct)
+        form = self._affine(ns)
+        free = np.flatnonzero(form[:, 1:].any(axis=0))
+        return form[:, 0], form[:, 1 + free].T
+    def sample(self, ns, shots=1, rng=None, counts=False):
+        # the shots just draw the free bits of _support, all at once:
+        # O(len(ns) n^2 + shots len(ns) k) for k random outcomes
+        try: ns = list(ns)
+        except TypeError: ns = [ns]
+        rng = get_rng(rng)
+        base, dirs = self._support(ns)
+        bits = rng.random((shots, len(dirs))) < 0.5
+        res = (np.dot(bits.astype(int), dirs.astype(int)) % 2
+            ^ base).astype(int)
+        if not counts: return res
+        hist = np.zeros([2] * len(ns), dtype=int)
+        np.add.at(hist, tuple(res.T), 1)
+        return hist
+    def _reduce(self, cols):
+        # the stabilizers row reduced on the bits cols (pairs of x or z and
+        # a qubit), each with a pivot that's the only 1 in its column:
+        # returns (x, z, r, k) with the k rows with pivots first
+        n = self.ndims
+        x, z, r = self.x[n:].copy(), self.z[n:].copy(), self.r[n:].copy()
+        k = 0
+        for use_x, a in cols:
+            col = (x if use_x else z)[:, a]
+            rows = np.nonzero(col[k:])[0] + k
+            if not len(rows): continue
+            p = rows[0]
+            for arr in (x, z, r): arr[[k, p]] = arr[[p, k]]
+            col = (x if use_x else z)[:, a]
+            hs = np.nonzero(col)[0]
+            hs = hs[hs != k]
+            if len(hs):
+                x[hs], z[hs], r[hs] = rowprod(x[k], z[k], r[k], x[hs], z[hs],
+                    r[hs])
+            k += 1
+        return x, z, r, k
+    def _local(self, ns):
+        # generators of the stabilizers acting only on ns, restricted to
+        # ns (in that order): reduce on everything outside ns, and what's
+        # left has nothing there
+        out = [a for a in range(self.ndims) if a not in ns]
+        x, z, r, k = self._reduce([(True, a) for a in out]
+            + [(False, a) for a in out])
+        return x[k:][:, ns], z[k:][:, ns], r[k:]
+    def marginal(self, ns):
+        # uniform over the outcomes _support allows
+        ns = list(ns)
+        base, dirs = self._support(ns)
+        k = len(dirs)
+        outs = np.dot(unflatten(np.arange(2 ** k), [2] * k),
+            dirs.astype(int)) % 2 ^ base
+        pdf = np.zeros([2] * len(ns))
+        pdf[tuple(outs.T)] = 2.0 ** -k
+        return pdf
+    def probs(self, out=None):
+        p = self.marginal(lrange(self.ndims))
+        if out is None: return p
+        out[...] = p
+        return out
+    def entropy(self, ns):
+        # entanglement entropy of ns in bits: |ns| minus the number of
+        # stabilizers acting only on ns. the reduced spectrum is flat, so
+        # this is also every Renyi entropy
+        return len(ns) - len(self._local(list(ns))[2])
+    def reduced_density(self, ns):
+        # 2^-|ns| times the sum of the group generated by _local(ns). a
+        # Pauli string (-1)^r X^x Z^z (with i per Y, x and z both set)
+        # takes |b> to (-1)^r i^#Y (-1)^(z . b) |b ^ x>
+        ns = list(ns)
+        m = len(ns)
+        gx, gz, gr = _group(*self._local(ns))
+        D = 2 ** m
+        b = np.arange(D)
+        weights = 2 ** np.arange(m - 1, -1, -1)
+        rho = np.zeros((D, D), dtype=computer.default_dtype)
+        for x, z, r in zip(gx, gz, gr):
+            sign = 1 - 2 * (np.dot(unflatten(b, [2] * m), z) % 2)
+            val = (-1) ** r * 1j ** np.sum(x & z) * sign
+            rho[b ^ np.dot(x, weights), b] += val
+        return rho / D
+    def entries(self, thresh=0.0, top=None):
+        # the basis states with nonzero amplitude are those _support(all)
+        # allows, with probability 2^-k each. reducing the stabilizers on
+        # their x bits gives k whose x parts span dirs (with pivots, so
+        # counting in binary over them goes in index order); for g in the
+        # group they generate, psi = g psi makes the amplitude of
+        # base ^ x(g) that of base times the phase g picks up, as in
+        # reduced_density. amplitudes are relative to a real positive one
+        n = self.ndims
+        x, z, r, k = self._reduce([(True, a) for a in range(n)])
+        count = 2 ** k if top is None else min(top, 2 ** k)
+        if 2.0 ** -k < thresh: count = 0
+        base = self._support(lrange(n))[0].copy()
+        for i in range(k): # clear the pivots
+            if base[np.argmax(x[i])]: base ^= x[i]
+        sel = unflatten(np.arange(count), [2] * k).astype(bool)
+        gx, gz, gr = _group(x[:k], z[:k], r[:k], sel)
+        digs = gx ^ base
+        sign = 1 - 2 * (np.sum(gz & base, axis=1) % 2)
+        amps = ((-1.0) ** gr * 1j ** np.sum(gx & gz, axis=1) * sign
+            * 2.0 ** (-k / 2)).astype(computer.default_dtype)
+        weights = 1 << np.arange(n - 1, -1, -1).astype(object)
+        if n < 63: weights = weights.astype(np.int64)
+        idx = np.dot(digs.astype(weights.dtype), weights)
+        return idx, np.full(count, 2.0 ** -k), amps
+    def stream(self, thresh=0.0, chunk=2**20): yield self.entries(thresh)
+    def to_qc(self):
+        # the same state as a dense QC, by replaying gates and measurements
+        qc = QC(self.ndims)
+        for op in self.history:
+            if op[0] == "g": qc.gate(op[1], op[2])
+            else: qc.measure_as(op[1], op[2])
+        return qc
+    def _densify(self):
+        qc = self.to_qc()
+        self.__class__ = QC
+        self.__dict__.clear()
+        self.__dict__.update(qc.__dict__)
+    def equal_superposition(self, states):
+        self._densify()
+        self.equal_superposition(states)
+    def checkpoint(self, path): self.to_qc().checkpoint(path)
+
+per_subsystem(StabilizerQC)
+StabilizerQC.ma = StabilizerQC.measure_as
+StabilizerQC.m = StabilizerQC.measure
+StabilizerQC.g = StabilizerQC.gate
+StabilizerQC.s = StabilizerQC.sample
+StabilizerQC.k = StabilizerQC.kraus
+StabilizerQC.esp = StabilizerQC.equal_superposition